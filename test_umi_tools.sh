@@ -7,7 +7,7 @@ export PYTHONHASHSEED=0
 if [ $TEST_STYLE ] ; then
     nosetests -v tests/test_style.py ;
 elif [ $TEST_FUNCTIONALITY ] ; then
-    nosetests -v tests/test_umi_tools.py ;
+    nosetests -v tests/test_umi_tools.py tests/test_network.py ;
 fi
 
 
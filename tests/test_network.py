@@ -0,0 +1,282 @@
+'''test_network.py
+==================
+nose tests for the cell barcode clustering in umi_tools.network
+
+   nosetests tests/test_network.py
+'''
+
+import itertools
+import random
+
+import regex
+
+from nose.tools import ok_
+
+import umi_tools.network as network
+
+BARCODE_COUNTS = {"AAAAAA": 1000,
+                  "AAAAAT": 50,
+                  "CCCCCC": 500,
+                  "CCCCC": 20,
+                  "GGGGGG": 300,
+                  "GGGGGA": 100}
+
+
+def get_neighbours_regex(barcodes):
+    ''' return the neighbours of each barcode found with the fuzzy
+    regexes which get_neighbours_fuzzy replaces'''
+
+    neighbours = []
+    for barcode in barcodes:
+        comp_regex_err = regex.compile("(%s){e<=1}" % barcode)
+        comp_regex_del = regex.compile("(%s){i<=1}" % barcode[::-1])
+        neighbours.append(
+            [j for j, other in enumerate(barcodes) if other != barcode and
+             (comp_regex_err.match(other) or comp_regex_del.match(other))])
+
+    return neighbours
+
+
+def test_get_neighbours_fuzzy():
+    ''' the deletion index finds the barcodes matched by the regexes'''
+
+    random.seed(1)
+    for length in (4, 5, 6):
+        barcodes = set()
+        for i in range(200):
+            barcode_length = length + random.choice((-1, 0, 0, 1))
+            barcodes.add("".join(random.choice("ACGT")
+                                 for x in range(barcode_length)))
+        barcodes = sorted(barcodes)
+
+        neighbours = network.get_neighbours_fuzzy(barcodes)
+        expected = get_neighbours_regex(barcodes)
+
+        ok_(neighbours == expected,
+            "neighbours differ for barcodes of length %i" % length)
+
+
+def test_cell_clusterer_fuzzy():
+    ''' barcodes within one edit are grouped with barcodes with at
+    least dir_threshold times their counts'''
+
+    clusterer = network.CellClusterer("directional", dir_threshold=10,
+                                      fuzzy_match=True)
+    groups = clusterer(list(BARCODE_COUNTS), BARCODE_COUNTS)
+
+    expected = [["AAAAAA", "AAAAAT"],
+                ["CCCCCC", "CCCCC"],
+                ["GGGGGG"],
+                ["GGGGGA"]]
+
+    ok_(groups == expected, "%s is not %s" % (groups, expected))
+
+
+def test_cell_clusterer():
+    ''' without fuzzy matching, barcodes within one substitution are
+    grouped as for the directional method'''
+
+    clusterer = network.CellClusterer("directional", fuzzy_match=False)
+    counts = {x.encode(): count for x, count in BARCODE_COUNTS.items()
+              if len(x) == 6}
+    barcodes = list(counts)
+    groups = clusterer(barcodes, counts)
+
+    expected = [[b"AAAAAA", b"AAAAAT"],
+                [b"CCCCCC"],
+                [b"GGGGGG", b"GGGGGA"]]
+
+    ok_(groups == expected, "%s is not %s" % (groups, expected))
+
+    # each barcode is in one group
+    ok_(sorted(itertools.chain(*groups)) == sorted(barcodes))
+
+
+def breadth_first_search(node, adj_list):
+    ''' the breadth first search used by UMIClusterer before the
+    neighbour indexes, which fixes the order of the umis in each set'''
+
+    searched = set()
+    queue = set()
+    queue.update((node,))
+    searched.update((node,))
+
+    while len(queue) > 0:
+        node = queue.pop()
+        for next_node in adj_list[node]:
+            if next_node not in searched:
+                queue.update((next_node,))
+                searched.update((next_node,))
+
+    return searched
+
+
+def cluster_pairwise(umis, counts, threshold):
+    ''' return the groups of the cluster method found by comparing all
+    pairs of umis and searching the adjacency list breadth first'''
+
+    adj_list = {umi: [] for umi in umis}
+    for umi1, umi2 in itertools.combinations(umis, 2):
+        if network.edit_distance(umi1, umi2) <= threshold:
+            adj_list[umi1].append(umi2)
+            adj_list[umi2].append(umi1)
+
+    found = set()
+    groups = []
+    for node in sorted(adj_list, key=lambda x: counts[x], reverse=True):
+        if node not in found:
+            component = breadth_first_search(node, adj_list)
+            found.update(component)
+            groups.append(sorted(component, key=lambda x: counts[x],
+                                 reverse=True))
+
+    return groups
+
+
+def test_cluster_ties():
+    ''' the cluster method takes tied umis in the same order as the
+    pairwise comparison and breadth first search, with or without an
+    interner'''
+
+    random.seed(1)
+    for threshold in (1, 2):
+        interner = network.UMIInterner()
+        clusterers = (network.UMIClusterer("cluster"),
+                      network.UMIClusterer("cluster", interner=interner),
+                      network.UMIClusterer("cluster", cache_size=10))
+
+        for i in range(50):
+            umis = set()
+            for j in range(random.randint(3, 100)):
+                umis.add("".join(random.choice("ACGT")
+                                 for k in range(6)).encode())
+            umis = list(umis)
+            # few distinct counts, so most umis are tied
+            counts = {umi: random.randint(1, 3) for umi in umis}
+
+            expected = cluster_pairwise(umis, counts, threshold)
+
+            for clusterer in clusterers:
+                if clusterer.interner is None:
+                    groups = clusterer(umis, counts, threshold)
+                else:
+                    codes = [interner(x) for x in umis]
+                    code_counts = {interner(x): counts[x] for x in umis}
+                    groups = [[interner.decode(x) for x in group] for group
+                              in clusterer(codes, code_counts, threshold)]
+
+                ok_(groups == expected,
+                    "%s is not %s at threshold %i" % (
+                        groups, expected, threshold))
+
+
+def get_mutated_umis(n, length, seed):
+    ''' return n distinct umis, most of which are a few substitutions
+    from another, so they have neighbours at thresholds 1 and 2'''
+
+    random.seed(seed)
+    umis = set()
+    umi_list = []
+    while len(umi_list) < n:
+        if len(umi_list) == 0 or random.random() < 0.2:
+            umi = [random.choice("ACGT") for k in range(length)]
+        else:
+            umi = list(random.choice(umi_list).decode())
+            for k in random.sample(range(length), random.randint(1, 2)):
+                umi[k] = random.choice("ACGT")
+        umi = "".join(umi).encode()
+        if umi not in umis:
+            umis.add(umi)
+            umi_list.append(umi)
+
+    return umi_list
+
+
+def get_neighbours_reference(umis, threshold):
+    ''' return the neighbours found without the neighbour cache'''
+
+    if threshold == 1:
+        return network.get_neighbours_substitution(umis)
+    else:
+        return network.get_neighbours_multi_index(umis, threshold)
+
+
+def test_neighbour_cache():
+    ''' the neighbour cache finds the same neighbours as the substitution
+    hash and multi-index for bundles too large to compare all-pairs,
+    including after more umis have been interned'''
+
+    n_umis = network.MAX_PACKED_UMIS + 2000
+    umis = get_mutated_umis(2 * n_umis, 10, 1)
+    old_umis, new_umis = umis[:n_umis], umis[n_umis:]
+
+    for dense in (False, True):
+        for threshold in (1, 2):
+            interner = network.UMIInterner()
+            neighbour_cache = network.NeighbourCache(interner, 2 * n_umis,
+                                                     dense)
+
+            codes = [interner(x) for x in old_umis]
+            ok_(neighbour_cache.get_neighbours(codes, threshold) ==
+                get_neighbours_reference(old_umis, threshold),
+                "neighbours differ at threshold %i" % threshold)
+
+            # cached entries are found again for the umis interned since
+            bundle = old_umis[::2] + new_umis[::2]
+            codes = [interner(x) for x in bundle]
+            ok_(neighbour_cache.get_neighbours(codes, threshold) ==
+                get_neighbours_reference(bundle, threshold),
+                "neighbours differ after interning at threshold %i" %
+                threshold)
+
+
+def test_lru_cache():
+    ''' the least recently used values are evicted once the cache is
+    full and the hits, misses and evictions are counted'''
+
+    cache = network.LRUCache(2)
+    ok_(cache.get("a") is None)
+    cache.add("a", 1)
+    cache.add("b", 2)
+    ok_(cache.get("a") == 1)
+
+    # "b" is now the least recently used
+    cache.add("c", 3)
+    ok_(cache.get("b") is None)
+    ok_(cache.get("a") == 1)
+    ok_(cache.get("c") == 3)
+
+    cache.add("d", 4)
+    ok_(list(cache.cache) == ["c", "d"])
+    ok_((cache.hits, cache.misses, cache.evictions) == (3, 2, 2),
+        "%i hits, %i misses and %i evictions" % (
+            cache.hits, cache.misses, cache.evictions))
+
+
+def test_cached_clusterer():
+    ''' a cached clusterer returns the same groups for a repeated bundle
+    as for the first, and as a clusterer without the cache'''
+
+    random.seed(1)
+    for method in ("adjacency", "directional", "cluster"):
+        clusterer = network.UMIClusterer(method)
+        cached_clusterer = network.UMIClusterer(method, cache_size=5)
+
+        bundles = []
+        for i in range(10):
+            umis = list(set("".join(random.choice("ACGT")
+                                    for k in range(5)).encode()
+                            for j in range(50)))
+            counts = {umi: random.randint(1, 3) for umi in umis}
+            bundles.append((umis, counts))
+
+        # the first five bundles are cached, the rest are evicted in turn
+        for umis, counts in bundles[:5] + bundles:
+            expected = clusterer(umis, counts, 1)
+            ok_(cached_clusterer(umis, counts, 1) == expected,
+                "cached groups differ for the %s method" % method)
+
+        cache = cached_clusterer.cache
+        ok_((cache.hits, cache.misses, cache.evictions) == (5, 10, 5),
+            "%i hits, %i misses and %i evictions" % (
+                cache.hits, cache.misses, cache.evictions))
@@ -0,0 +1,621 @@
+import collections
+import heapq
+import random
+import re
+
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, int32_t, int64_t, \
+    uint64_t
+from libc.string cimport memcpy, strlen
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.dict cimport PyDict_GetItem
+from cpython.object cimport PyObject
+from pysam.libcalignedsegment cimport AlignedSegment
+from pysam.libchtslib cimport bam1_t, bam_cigar_op, bam_cigar_oplen, \
+    bam_get_qname, bam_get_aux, bam_get_l_aux, \
+    BAM_CMATCH, BAM_CINS, BAM_CDEL, BAM_CREF_SKIP, BAM_CSOFT_CLIP, \
+    BAM_CEQUAL, BAM_CDIFF, BAM_FUNMAP, BAM_FMUNMAP, BAM_FREVERSE, BAM_FREAD2
+
+cdef extern from "htslib/sam.h":
+    uint32_t * bam_get_cigar(bam1_t * b)
+
+# The fields get_bundles needs from each read are read straight from the
+# htslib record behind the AlignedSegment
+
+
+cdef class BundleEntry:
+    ''' the read kept for a umi at a position/key (or the list of reads
+    if all reads are retained), the number of reads with the umi and the
+    reservoir count used to pick between reads of equal quality, or with
+    hash selection the hash of the read. If all reads are retained,
+    positions holds the 5' position of each read '''
+
+    cdef public object read
+    cdef public object positions
+    cdef public long count
+    cdef public long reservoir
+    cdef public uint64_t read_hash
+
+    def __init__(self, read, positions=None, read_hash=0):
+        self.read = read
+        self.positions = positions
+        self.count = 1
+        self.reservoir = 0
+        self.read_hash = read_hash
+
+
+def group_entries(dict entries):
+    ''' group the BundleEntrys buffered for a position, keyed by
+    (key, umi), into a bundle for each key. Bundles, and umis within a
+    bundle, are in the order they were first seen '''
+
+    cdef dict bundles = {}
+    for (key, umi), entry in entries.items():
+        try:
+            bundles[key][umi] = entry
+        except KeyError:
+            bundles[key] = {umi: entry}
+
+    return bundles.values()
+
+
+def count_buffered(dict entries, bint all_reads):
+    ''' return the number of reads held in the BundleEntrys for a
+    position '''
+
+    cdef BundleEntry entry
+    cdef long n = 0
+
+    if all_reads:
+        for entry in entries.values():
+            n += entry.count
+        return n
+    else:
+        return len(entries)
+
+
+cdef inline uint64_t mix64(uint64_t x):
+    ''' the splitmix64 finaliser '''
+    x ^= x >> 30
+    x *= 0xbf58476d1ce4e5b9ULL
+    x ^= x >> 27
+    x *= 0x94d049bb133111ebULL
+    x ^= x >> 31
+    return x
+
+
+cdef uint64_t name_hash(bam1_t * b, uint64_t seed):
+    ''' return a 64 bit FNV-1a hash of the read name, seeded and then
+    mixed with mix64. Both mates of a pair hash the same '''
+
+    cdef uint8_t * qname = <uint8_t *>bam_get_qname(b)
+    cdef uint64_t h = 0xcbf29ce484222325ULL ^ mix64(seed)
+
+    while qname[0] != 0:
+        h ^= qname[0]
+        h *= 0x100000001b3ULL
+        qname += 1
+
+    return mix64(h)
+
+
+cdef inline double hash_fraction(uint64_t h):
+    ''' return a hash as a fraction in [0, 1) '''
+    return (h >> 11) * (1.0 / 9007199254740992.0)
+
+
+def get_read_hash(AlignedSegment read, uint64_t seed):
+    ''' return the seeded hash of the read name used by hash selection
+    in get_bundles '''
+    return name_hash(read._delegate, seed)
+
+
+def get_hash_fraction(uint64_t h):
+    ''' return a hash from get_read_hash as a fraction in [0, 1) '''
+    return hash_fraction(h)
+
+
+cdef bint read_position(bam1_t * b, double soft_clip_threshold,
+                        int64_t * start, int64_t * pos, uint32_t * span):
+    ''' set start and pos as get_read_position and span to the query
+    length from the cigar, including soft clipped bases. Return whether
+    the read is spliced. The read must be mapped '''
+
+    cdef uint32_t * cigar = bam_get_cigar(b)
+    cdef uint32_t n_cigar = b.core.n_cigar
+    cdef uint32_t k, op, first_clip, last_clip
+    cdef int64_t aend = b.core.pos
+    cdef bint spliced = False
+
+    span[0] = 0
+    if n_cigar == 0:
+        start[0] = b.core.pos
+        pos[0] = b.core.pos
+        return False
+
+    # one pass over the cigar for the reference end, the query length,
+    # the clipping at either end and any skipped region
+    for k in range(n_cigar):
+        op = bam_cigar_op(cigar[k])
+        if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+            aend += bam_cigar_oplen(cigar[k])
+            span[0] += bam_cigar_oplen(cigar[k])
+        elif op == BAM_CDEL:
+            aend += bam_cigar_oplen(cigar[k])
+        elif op == BAM_CREF_SKIP:
+            aend += bam_cigar_oplen(cigar[k])
+            spliced = True
+        elif op == BAM_CINS or op == BAM_CSOFT_CLIP:
+            span[0] += bam_cigar_oplen(cigar[k])
+
+    first_clip = 0
+    if bam_cigar_op(cigar[0]) == BAM_CSOFT_CLIP:
+        first_clip = bam_cigar_oplen(cigar[0])
+    last_clip = 0
+    if bam_cigar_op(cigar[n_cigar - 1]) == BAM_CSOFT_CLIP:
+        last_clip = bam_cigar_oplen(cigar[n_cigar - 1])
+
+    if b.core.flag & BAM_FREVERSE:
+        pos[0] = aend + last_clip
+        start[0] = b.core.pos
+        if first_clip > soft_clip_threshold:
+            spliced = True
+    else:
+        pos[0] = b.core.pos - first_clip
+        start[0] = pos[0]
+        if last_clip > soft_clip_threshold:
+            spliced = True
+
+    return spliced
+
+
+cdef inline tuple read_key(bam1_t * b, bint is_spliced, bint spliced,
+                           bint paired, bint read_length):
+    ''' return the key reads at the same position are bundled by: the
+    strand, the splice status if spliced is set, the template length
+    if paired is set and the read length if read_length is set '''
+
+    return (bool(b.core.flag & BAM_FREVERSE), spliced and is_spliced,
+            paired * b.core.isize, b.core.l_qseq if read_length else 0)
+
+
+def get_read_position(AlignedSegment read, double soft_clip_threshold):
+    ''' return the start, the 5' position and whether a mapped read is
+    spliced, from one pass over its cigar. For reverse strand reads the
+    5' position is the end of the alignment. Soft clipped bases count
+    towards the 5' position, and a read is spliced if it skips a region
+    of the reference or has more than soft_clip_threshold bases soft
+    clipped at its 3' end '''
+
+    cdef int64_t start, pos
+    cdef uint32_t span
+    cdef bint is_spliced = read_position(
+        read._delegate, soft_clip_threshold, &start, &pos, &span)
+
+    return start, pos, is_spliced
+
+
+def get_read_key(AlignedSegment read, double soft_clip_threshold,
+                 bint spliced=False, bint paired=False,
+                 bint read_length=False):
+    ''' return the start, the 5' position and the bundle key of a mapped
+    read, as used by get_bundles '''
+
+    cdef int64_t start, pos
+    cdef uint32_t span
+    cdef bint is_spliced = read_position(
+        read._delegate, soft_clip_threshold, &start, &pos, &span)
+
+    return start, pos, read_key(read._delegate, is_spliced, spliced, paired,
+                                read_length)
+
+
+def get_bundles(inreads,
+                bint ignore_umi=False,
+                subset=None,
+                int quality_threshold=0,
+                bint paired=False,
+                bint spliced=False,
+                double soft_clip_threshold=0,
+                bint per_contig=False,
+                gene_tag=None,
+                skip_regex=None,
+                bint whole_contig=False,
+                bint read_length=False,
+                detection_method=False,
+                umi_getter=None,
+                bint all_reads=False,
+                bint return_read2=False,
+                bint return_unmapped=False,
+                int64_t window=1000,
+                bint adaptive_window=False,
+                hash_seed=None,
+                buffer_stats=None):
+    ''' compiled version of umi_methods.get_bundles_python, with the same
+    arguments and yielding the same bundles. The flags, positions and
+    mapping qualities are read from the htslib records '''
+
+    cdef AlignedSegment read, best
+    cdef bam1_t * b
+    cdef uint16_t flag
+    cdef int64_t start, read_pos, last_pos = 0
+    cdef uint32_t span
+    cdef bint is_spliced
+    cdef BundleEntry entry
+    cdef dict entries, out_entries
+    cdef dict reads_dict = {}
+    cdef double subset_fraction = subset or 0
+    cdef bint queue_positions = not (per_contig or gene_tag or whole_contig)
+    cdef bint check_tag = detection_method in ["NH", "X0"]
+    cdef bint check_xt = detection_method == "XT"
+    cdef long n_positions = 0, n_buffered = 0, peak_buffered = 0
+    cdef long peak_positions = 0
+    cdef list position_queue = []
+    cdef list expired, out_keys
+    cdef bint use_hash = hash_seed is not None
+    cdef uint64_t seed = hash_seed if use_hash else 0
+    cdef uint64_t h = 0
+    cdef bint selected
+
+    rand = random.random
+    last_chr = ""
+    read_events = collections.Counter()
+
+    for read in inreads:
+        b = read._delegate
+        flag = b.core.flag
+
+        if flag & BAM_FREAD2:
+            if return_read2:
+                if not flag & BAM_FUNMAP or return_unmapped:
+                    yield read, read_events, 'single_read'
+            continue
+        else:
+            read_events['Input Reads'] += 1
+
+        if flag & BAM_FUNMAP:
+            if paired:
+                if flag & BAM_FMUNMAP:
+                    read_events['Both unmapped'] += 1
+                else:
+                    read_events['Read 1 unmapped'] += 1
+            else:
+                read_events['Single end unmapped'] += 1
+
+            if return_unmapped:
+                read_events['Input Reads'] += 1
+                yield read, read_events, 'single_read'
+            continue
+
+        if flag & BAM_FMUNMAP and paired:
+            read_events['Read 2 unmapped'] += 1
+            if return_unmapped:
+                yield read, read_events, 'single_read'
+            continue
+
+        if paired:
+            read_events['Paired Reads'] += 1
+
+        if use_hash and (subset_fraction or not all_reads):
+            h = name_hash(b, seed)
+
+        if subset_fraction:
+            if use_hash:
+                selected = hash_fraction(h) < subset_fraction
+            else:
+                selected = rand() < subset_fraction
+            if not selected:
+                read_events['Randomly excluded'] += 1
+                continue
+
+        if quality_threshold:
+            if b.core.qual < quality_threshold:
+                read_events['< MAPQ threshold'] += 1
+                continue
+
+        if per_contig or gene_tag:
+
+            if per_contig:
+                pos = b.core.tid
+                key = pos
+            else:
+                pos = read.get_tag(gene_tag)
+                key = pos
+                if re.search(skip_regex, pos):
+                    continue
+
+            if all_reads:
+                read_position(b, soft_clip_threshold, &start, &read_pos,
+                              &span)
+
+            if not pos == last_chr:
+
+                peak_buffered = max(peak_buffered, n_buffered)
+                peak_positions = max(peak_positions, len(reads_dict))
+
+                out_keys = list(reads_dict.keys())
+
+                for p in out_keys:
+                    out_entries = reads_dict.pop(p)
+                    for bundle in group_entries(out_entries):
+                        yield bundle, read_events, 'mapped'
+                    n_buffered -= count_buffered(out_entries, all_reads)
+
+                last_chr = pos
+
+        else:
+
+            is_spliced = read_position(
+                b, soft_clip_threshold, &start, &read_pos, &span)
+            pos = read_pos
+
+            if adaptive_window:
+                if span > window:
+                    window = span
+
+            if whole_contig:
+                do_output = not b.core.tid == last_chr
+            else:
+                do_output = (start > (last_pos+window) or
+                             not b.core.tid == last_chr)
+
+            if do_output:
+                peak_buffered = max(peak_buffered, n_buffered)
+                peak_positions = max(peak_positions, len(reads_dict))
+
+                if not b.core.tid == last_chr:
+                    out_keys = list(reads_dict.keys())
+                    position_queue = []
+                else:
+                    expired = []
+                    while (position_queue and
+                           position_queue[0][0] <= start-window):
+                        expired.append(heapq.heappop(position_queue))
+
+                    # output positions in the order they were added
+                    expired.sort(key=lambda x: x[1])
+                    out_keys = [p for p, order in expired]
+
+                for p in out_keys:
+                    out_entries = reads_dict.pop(p)
+                    for bundle in group_entries(out_entries):
+                        yield bundle, read_events, 'mapped'
+                    n_buffered -= count_buffered(out_entries, all_reads)
+
+                last_pos = start
+                last_chr = b.core.tid
+
+            key = read_key(b, is_spliced, spliced, paired, read_length)
+
+        if ignore_umi:
+            umi = ""
+        else:
+            umi = umi_getter(read)
+
+        try:
+            entries = reads_dict[pos]
+        except KeyError:
+            entries = reads_dict[pos] = {}
+            if queue_positions:
+                heapq.heappush(position_queue, (pos, n_positions))
+                n_positions += 1
+
+        try:
+            entry = entries[key, umi]
+        except KeyError:
+            # The content of the entry depends on whether all reads
+            # are being retained
+            if all_reads:
+                entries[key, umi] = BundleEntry([read], [read_pos])
+            else:
+                entries[key, umi] = BundleEntry(read, read_hash=h)
+            n_buffered += 1
+            continue
+
+        entry.count += 1
+
+        if all_reads:
+            # retain all reads per key
+            entry.read.append(read)
+            entry.positions.append(read_pos)
+            n_buffered += 1
+            continue
+
+        # retain just a single read per key
+        best = entry.read
+        if best._delegate.core.qual > b.core.qual:
+            continue
+
+        if best._delegate.core.qual < b.core.qual:
+            entry.read = read
+            entry.reservoir = 0
+            entry.read_hash = h
+            continue
+
+        if check_tag:
+            if best.opt(detection_method) < read.opt(detection_method):
+                continue
+            elif best.opt(detection_method) > read.opt(detection_method):
+                entry.read = read
+                entry.reservoir = 0
+                entry.read_hash = h
+
+        elif check_xt:
+            if best.opt("XT") == "U":
+                continue
+            elif read.opt("XT") == "U":
+                entry.read = read
+                entry.reservoir = 0
+                entry.read_hash = h
+
+        if use_hash:
+            # keep the read with the lowest hash, whatever the read order
+            if h < entry.read_hash:
+                entry.read = read
+                entry.read_hash = h
+            continue
+
+        entry.reservoir += 1
+
+        if rand() < 1.0/entry.reservoir:
+            entry.read = read
+
+    # yield remaining bundles
+    peak_buffered = max(peak_buffered, n_buffered)
+    peak_positions = max(peak_positions, len(reads_dict))
+
+    for p in reads_dict:
+        for bundle in group_entries(reads_dict[p]):
+            yield bundle, read_events, 'mapped'
+
+    if buffer_stats is not None:
+        for name, value in (("reads", peak_buffered),
+                            ("positions", peak_positions)):
+            buffer_stats[name] = max(buffer_stats[name], value)
+        if queue_positions:
+            buffer_stats["window"] = max(buffer_stats["window"], window)
+
+
+cdef class ReadIdUMIGetter:
+    ''' compiled get_umi_read_id. The read name is scanned from the
+    end for a single character separator. If umi_length is set, UMIs of
+    any other length raise a ValueError. with_interner returns a getter
+    which returns the code of the UMI in a UMIInterner instead '''
+
+    cdef object sep
+    cdef bytes sep_bytes
+    cdef int umi_length
+    cdef object interner
+    cdef dict umi2code
+
+    def __init__(self, sep="_", umi_length=0, interner=None):
+        self.sep = sep
+        self.sep_bytes = sep.encode('utf-8')
+        self.umi_length = umi_length
+        self.interner = interner
+        if interner is not None:
+            self.umi2code = interner.umi2code
+
+    def with_interner(self, interner):
+        return ReadIdUMIGetter(self.sep, self.umi_length, interner)
+
+    cdef bytes get_umi(self, AlignedSegment read):
+        cdef bam1_t * b = read._delegate
+        cdef char * qname = bam_get_qname(b)
+        cdef Py_ssize_t n = strlen(qname)
+        cdef Py_ssize_t i = n
+        cdef char sep
+
+        if len(self.sep_bytes) == 1:
+            sep = self.sep_bytes[0]
+            while i > 0 and qname[i - 1] != sep:
+                i -= 1
+            return PyBytes_FromStringAndSize(qname + i, n - i)
+        else:
+            return read.query_name.split(self.sep)[-1].encode('utf-8')
+
+    def __call__(self, AlignedSegment read):
+        umi = self.get_umi(read)
+        return intern_umi(self.interner, self.umi2code, umi,
+                          self.umi_length)
+
+
+cdef class TagUMIGetter:
+    ''' compiled get_umi_tag. String tags are read straight from the
+    record's aux data, up to the first "-". If umi_length is set, UMIs
+    of any other length raise a ValueError. with_interner returns a
+    getter which returns the code of the UMI in a UMIInterner
+    instead '''
+
+    cdef object tag
+    cdef bytes tag_bytes
+    cdef int umi_length
+    cdef object interner
+    cdef dict umi2code
+
+    def __init__(self, tag="RX", umi_length=0, interner=None):
+        self.tag = tag
+        self.tag_bytes = tag.encode('utf-8')
+        self.umi_length = umi_length
+        self.interner = interner
+        if interner is not None:
+            self.umi2code = interner.umi2code
+
+    def with_interner(self, interner):
+        return TagUMIGetter(self.tag, self.umi_length, interner)
+
+    cdef bytes get_umi(self, AlignedSegment read):
+        cdef bam1_t * b = read._delegate
+        cdef uint8_t * aux = bam_get_aux(b)
+        cdef uint8_t * end = aux + bam_get_l_aux(b)
+        cdef char * tag = self.tag_bytes
+        cdef uint8_t * value
+        cdef Py_ssize_t n
+        cdef int32_t count
+        cdef int size
+
+        if len(self.tag_bytes) != 2:
+            end = aux
+
+        while aux + 3 <= end:
+            if aux[0] == tag[0] and aux[1] == tag[1]:
+                if aux[2] != b'Z':
+                    break
+                value = aux + 3
+                n = 0
+                while value + n < end and value[n] != 0 and value[n] != b'-':
+                    n += 1
+                return PyBytes_FromStringAndSize(<char *>value, n)
+
+            # skip to the next field
+            if aux[2] in b'AcC':
+                aux += 4
+            elif aux[2] in b'sS':
+                aux += 5
+            elif aux[2] in b'iIf':
+                aux += 7
+            elif aux[2] == b'd':
+                aux += 11
+            elif aux[2] in b'ZH':
+                aux += 3
+                while aux < end and aux[0] != 0:
+                    aux += 1
+                aux += 1
+            elif aux[2] == b'B' and aux + 8 <= end:
+                if aux[3] in b'cC':
+                    size = 1
+                elif aux[3] in b'sS':
+                    size = 2
+                else:
+                    size = 4
+                memcpy(&count, aux + 4, 4)
+                aux += 8 + <Py_ssize_t>count * size
+            else:
+                break
+
+        # anything other than a string tag is left to pysam
+        return read.get_tag(self.tag).split("-")[0].encode('utf-8')
+
+    def __call__(self, AlignedSegment read):
+        umi = self.get_umi(read)
+        return intern_umi(self.interner, self.umi2code, umi,
+                          self.umi_length)
+
+
+cdef inline object intern_umi(object interner, dict umi2code, bytes umi,
+                              int umi_length):
+    ''' return umi, or its code if there is an interner, checking its
+    length if umi_length is set '''
+
+    cdef PyObject * code
+
+    if umi_length and len(umi) != umi_length:
+        raise ValueError(
+            "UMI %s is not %i bases long" % (umi.decode(), umi_length))
+
+    if interner is None:
+        return umi
+
+    code = PyDict_GetItem(umi2code, umi)
+    if code == NULL:
+        return interner(umi)
+    return <object>code
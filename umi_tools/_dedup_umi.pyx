@@ -1,3 +1,17 @@
+import numpy as np
+
+from libc.stdint cimport int64_t, uint64_t
+from libc.stdlib cimport malloc, calloc, realloc, free, qsort
+
+# UMIs of up to 32 bases are packed into a uint64 at 2 bits per base. A
+# second uint64 marks the positions holding an N, which are packed as
+# A. The mask bit is set on the low bit of the position's 2 bits. By
+# default an N only matches an N. With wildcard set, the kernels below
+# treat an N as matching any base
+cdef int MAX_PACKED_LENGTH = 32
+cdef uint64_t LOW_BITS = 0x5555555555555555ULL
+
+
 cpdef int edit_distance(a, b):
     cdef char * aa = a
     cdef char * bb = b
@@ -11,3 +25,353 @@ cpdef int edit_distance(a, b):
         if aa[k] != bb[k]:
             c += 1
     return c
+
+
+cpdef int edit_distance_wildcard(a, b):
+    ''' as edit_distance, but an N matches any base '''
+    cdef char * aa = a
+    cdef char * bb = b
+
+    cdef int k, l, c
+
+    c = 0
+
+    l = len(a)
+    for k from 0 <= k < l:
+        if aa[k] != bb[k] and aa[k] != b'N' and bb[k] != b'N':
+            c += 1
+    return c
+
+
+cdef inline int popcount(uint64_t x) nogil:
+    cdef uint64_t m1 = 0x5555555555555555ULL
+    cdef uint64_t m2 = 0x3333333333333333ULL
+    cdef uint64_t m4 = 0x0f0f0f0f0f0f0f0fULL
+    cdef uint64_t h01 = 0x0101010101010101ULL
+    x = x - ((x >> 1) & m1)
+    x = (x & m2) + ((x >> 2) & m2)
+    x = (x + (x >> 4)) & m4
+    return <int>((x * h01) >> 56)
+
+
+cdef inline int packed_distance(uint64_t code1, uint64_t mask1,
+                                uint64_t code2, uint64_t mask2,
+                                bint wildcard) nogil:
+    cdef uint64_t diff = code1 ^ code2
+    if wildcard:
+        return popcount((diff | (diff >> 1)) & LOW_BITS & ~(mask1 | mask2))
+    return popcount(((diff | (diff >> 1)) & LOW_BITS) | (mask1 ^ mask2))
+
+
+def encode_umis(umis):
+    ''' pack a list of umis into arrays of 2-bit codes and N masks.
+    Returns None if the umis can't be packed, i.e they are not all the
+    same length, are longer than 32 bases or contain bases other than
+    A, C, G, T or N '''
+
+    cdef Py_ssize_t n = len(umis), i, k, length
+    cdef const unsigned char[:] umi
+    cdef uint64_t code, mask
+    cdef unsigned char base
+
+    if n == 0:
+        return None
+
+    length = len(umis[0])
+    if length > MAX_PACKED_LENGTH:
+        return None
+
+    codes = np.zeros(n, dtype=np.uint64)
+    masks = np.zeros(n, dtype=np.uint64)
+    cdef uint64_t[:] codes_view = codes
+    cdef uint64_t[:] masks_view = masks
+
+    for i in range(n):
+        umi = umis[i]
+        if umi.shape[0] != length:
+            return None
+
+        code, mask = 0, 0
+        for k in range(length):
+            base = umi[k]
+            if base == b'A':
+                pass
+            elif base == b'C':
+                code |= (<uint64_t>1) << (2 * k)
+            elif base == b'G':
+                code |= (<uint64_t>2) << (2 * k)
+            elif base == b'T':
+                code |= (<uint64_t>3) << (2 * k)
+            elif base == b'N':
+                mask |= (<uint64_t>1) << (2 * k)
+            else:
+                return None
+
+        codes_view[i] = code
+        masks_view[i] = mask
+
+    return codes, masks
+
+
+def hamming_distances(uint64_t code, uint64_t mask,
+                      const uint64_t[:] codes, const uint64_t[:] masks,
+                      bint wildcard=False):
+    ''' return the hamming distances from one packed umi to an array of
+    packed umis '''
+
+    cdef Py_ssize_t n = codes.shape[0], j
+
+    distances = np.empty(n, dtype=np.int32)
+    cdef int[:] distances_view = distances
+
+    for j in range(n):
+        distances_view[j] = packed_distance(code, mask, codes[j], masks[j],
+                                            wildcard)
+
+    return distances
+
+
+def hamming_neighbours(const uint64_t[:] codes, const uint64_t[:] masks,
+                       int threshold, bint wildcard=False):
+    ''' return, for each packed umi, the indices of the packed umis within
+    the hamming distance threshold, in ascending order. This is the
+    thresholded distance matrix of the bundle '''
+
+    cdef Py_ssize_t n = codes.shape[0], i, j
+
+    neighbours = [[] for i in range(n)]
+
+    for i in range(n):
+        for j in range(i + 1, n):
+            if packed_distance(codes[i], masks[i], codes[j], masks[j],
+                               wildcard) <= threshold:
+                neighbours[i].append(j)
+                neighbours[j].append(i)
+
+    return neighbours
+
+
+def hamming_directional_neighbours(const uint64_t[:] codes,
+                                   const uint64_t[:] masks,
+                                   const int64_t[:] counts,
+                                   int threshold, bint wildcard=False):
+    ''' return, for each packed umi, the indices of the packed umis
+    within the hamming distance threshold which it can absorb, i.e
+    counts[i] >= (2 * counts[j]) - 1. The umis must be sorted by
+    ascending count, so the umis which can be absorbed are a prefix of
+    the array. The umis are processed in descending count order and
+    each is only compared with this prefix, which shrinks as the counts
+    fall '''
+
+    cdef Py_ssize_t n = codes.shape[0], i, j
+    cdef Py_ssize_t n_absorbable = n
+
+    neighbours = [[] for i in range(n)]
+
+    for i in range(n - 1, -1, -1):
+        while (n_absorbable > 0 and
+               counts[i] < (2 * counts[n_absorbable - 1]) - 1):
+            n_absorbable -= 1
+
+        if n_absorbable == 0:
+            break
+
+        for j in range(n_absorbable):
+            if j != i and packed_distance(codes[i], masks[i],
+                                          codes[j], masks[j],
+                                          wildcard) <= threshold:
+                neighbours[i].append(j)
+
+    return neighbours
+
+
+cdef int compare_indices(const void * a, const void * b) noexcept nogil:
+    cdef Py_ssize_t x = (<Py_ssize_t *>a)[0], y = (<Py_ssize_t *>b)[0]
+    return (x > y) - (x < y)
+
+
+cdef Py_ssize_t cluster_packed_nogil(const uint64_t[:] codes,
+                                     const uint64_t[:] masks,
+                                     const int64_t[:] counts,
+                                     int threshold, bint directional,
+                                     bint wildcard,
+                                     Py_ssize_t[:] order,
+                                     Py_ssize_t[:] offsets) noexcept nogil:
+    ''' cluster the packed umis into order and offsets, see
+    cluster_packed. Returns the number of groups or -1 if memory
+    couldn't be allocated '''
+
+    cdef Py_ssize_t n = codes.shape[0], i, j, k, start
+    cdef Py_ssize_t first = 0, n_edges = 0, capacity = n
+    cdef Py_ssize_t n_groups = 0, n_grouped = 0, head, tail
+    cdef Py_ssize_t * edge_starts = <Py_ssize_t *>malloc(
+        (n + 1) * sizeof(Py_ssize_t))
+    cdef Py_ssize_t * edges = <Py_ssize_t *>malloc(
+        capacity * sizeof(Py_ssize_t))
+    cdef Py_ssize_t * new_edges
+    cdef Py_ssize_t * visited = <Py_ssize_t *>malloc(n * sizeof(Py_ssize_t))
+    cdef Py_ssize_t * queue = <Py_ssize_t *>malloc(n * sizeof(Py_ssize_t))
+    cdef char * assigned = <char *>calloc(n, sizeof(char))
+
+    if (edge_starts == NULL or edges == NULL or visited == NULL or
+            queue == NULL or assigned == NULL):
+        n_groups = -1
+
+    # out edges of each umi, in compressed sparse row form. The umis are
+    # sorted by descending count, so for the directional method the
+    # umis which umi i can absorb are a suffix of the array, which
+    # shrinks as i increases
+    i = 0
+    while n_groups == 0 and i < n:
+        edge_starts[i] = n_edges
+        if directional:
+            while first < n and counts[i] < (2 * counts[first]) - 1:
+                first += 1
+        for j in range(first, n):
+            if j != i and packed_distance(codes[i], masks[i],
+                                          codes[j], masks[j],
+                                          wildcard) <= threshold:
+                if n_edges == capacity:
+                    capacity *= 2
+                    new_edges = <Py_ssize_t *>realloc(
+                        edges, capacity * sizeof(Py_ssize_t))
+                    if new_edges == NULL:
+                        n_groups = -1
+                        break
+                    edges = new_edges
+                edges[n_edges] = j
+                n_edges += 1
+        i += 1
+
+    # each unassigned umi in turn is the parent of a group holding the
+    # unassigned umis reachable from it. Umis assigned to an earlier
+    # group are still traversed
+    if n_groups == 0:
+        edge_starts[n] = n_edges
+        for i in range(n):
+            visited[i] = -1
+
+        for i in range(n):
+            if assigned[i]:
+                continue
+
+            visited[i] = i
+            queue[0] = i
+            head, tail = 0, 1
+            while head < tail:
+                j = queue[head]
+                head += 1
+                for k in range(edge_starts[j], edge_starts[j + 1]):
+                    if visited[edges[k]] != i:
+                        visited[edges[k]] = i
+                        queue[tail] = edges[k]
+                        tail += 1
+
+            offsets[n_groups] = n_grouped
+            n_groups += 1
+            start = n_grouped
+            for k in range(tail):
+                if not assigned[queue[k]]:
+                    assigned[queue[k]] = 1
+                    order[n_grouped] = queue[k]
+                    n_grouped += 1
+            qsort(&order[start], n_grouped - start, sizeof(Py_ssize_t),
+                  compare_indices)
+
+        offsets[n_groups] = n_grouped
+
+    free(edge_starts)
+    free(edges)
+    free(visited)
+    free(queue)
+    free(assigned)
+
+    return n_groups
+
+
+def cluster_packed(const uint64_t[:] codes, const uint64_t[:] masks,
+                   const int64_t[:] counts, int threshold,
+                   bint directional=True, bint wildcard=False):
+    ''' cluster the packed umis of one bundle, which must be sorted by
+    descending count. Umis are connected if they are within the hamming
+    distance threshold and, for the directional method, the counts of
+    the first umi >= (2 * second umi counts)-1. For the cluster method,
+    set directional to False to return the connected components.
+
+    Returns the indices of the umis in group order and the offsets of
+    each group, with the parent umi at position 0 of each group. The
+    groups and the umis within each group are in descending count order.
+    The clustering runs with the GIL released '''
+
+    cdef Py_ssize_t n = codes.shape[0], n_groups
+
+    order = np.empty(n, dtype=np.intp)
+    offsets = np.empty(n + 1, dtype=np.intp)
+    cdef Py_ssize_t[:] order_view = order
+    cdef Py_ssize_t[:] offsets_view = offsets
+
+    if n == 0:
+        return order, np.zeros(1, dtype=np.intp)
+
+    with nogil:
+        n_groups = cluster_packed_nogil(codes, masks, counts, threshold,
+                                        directional, wildcard, order_view,
+                                        offsets_view)
+
+    if n_groups == -1:
+        raise MemoryError()
+
+    return order, offsets[:n_groups + 1]
+
+
+def cluster_packed_batch(const uint64_t[:] codes, const uint64_t[:] masks,
+                         const int64_t[:] counts,
+                         const Py_ssize_t[:] bundle_offsets, int threshold,
+                         bint directional=True, bint wildcard=False):
+    ''' cluster many bundles of packed umis in a single call, as for
+    cluster_packed. The umis of bundle i are at bundle_offsets[i] to
+    bundle_offsets[i + 1] and the umis of each bundle must be sorted by
+    descending count.
+
+    Returns the indices of the umis in group order, the offsets of each
+    group and the offsets of the groups of each bundle '''
+
+    cdef Py_ssize_t n = codes.shape[0], b, g, i, start, end
+    cdef Py_ssize_t n_bundles = bundle_offsets.shape[0] - 1
+    cdef Py_ssize_t n_groups = 0, n_bundle_groups = 0
+
+    order = np.empty(n, dtype=np.intp)
+    group_offsets = np.zeros(n + 1, dtype=np.intp)
+    bundle_group_offsets = np.zeros(n_bundles + 1, dtype=np.intp)
+    cdef Py_ssize_t[:] order_view = order
+    cdef Py_ssize_t[:] group_offsets_view = group_offsets
+    cdef Py_ssize_t[:] bundle_group_offsets_view = bundle_group_offsets
+
+    with nogil:
+        for b in range(n_bundles):
+            start, end = bundle_offsets[b], bundle_offsets[b + 1]
+            bundle_group_offsets_view[b] = n_groups
+            if start == end:
+                continue
+
+            n_bundle_groups = cluster_packed_nogil(
+                codes[start:end], masks[start:end], counts[start:end],
+                threshold, directional, wildcard, order_view[start:end],
+                group_offsets_view[n_groups:])
+            if n_bundle_groups == -1:
+                break
+
+            # the bundle is clustered in place, so shift its indices
+            for g in range(n_groups, n_groups + n_bundle_groups):
+                group_offsets_view[g] += start
+            for i in range(start, end):
+                order_view[i] += start
+            n_groups += n_bundle_groups
+
+        bundle_group_offsets_view[n_bundles] = n_groups
+        group_offsets_view[n_groups] = n
+
+    if n_bundle_groups == -1:
+        raise MemoryError()
+
+    return order, group_offsets[:n_groups + 1], bundle_group_offsets
@@ -120,6 +120,33 @@ Options
        increased. The default value of 1 works best unless the UMI is
 very long (>14bp)
 
+--cluster-cache-size (int)
+       Cache the groups of up to this many recently clustered bundles
+       and reuse them for bundles with the same UMIs and counts. The
+       cache hits, misses and evictions are written to the log. The
+       default of 0 disables the cache
+
+--neighbour-cache-size (int)
+       Bundles with more than 10000 UMIs find the neighbours of each
+       UMI in a run-wide cache of the neighbours of up to this many
+       UMIs, rather than from scratch. The cache hits, misses and
+       evictions are written to the log. The UMIs are then held as
+       integer codes for the run, which are decoded for every bundle
+       unless --hash-selection is set. The default of 0 disables the
+       cache
+
+--dense-neighbour-table
+       For UMIs of up to 12 bases and the default edit distance
+       threshold, look up the neighbours of the UMIs in bundles with
+       more than 10000 UMIs in a table of every possible UMI. The table
+       for 12 base UMIs takes 64MB. As for --neighbour-cache-size, the
+       UMIs are held as integer codes for the run
+
+--wildcard-n
+       Treat an N in a UMI, e.g. from extract --quality-filter-mask, as
+       matching any base when comparing UMIs. By default an N is a
+       mismatch like any other base
+
 --paired
        BAM is paired end - output both read pairs. This will also
        force the Use of the template length to determine reads with
@@ -131,12 +158,6 @@ very long (>14bp)
        and the other is not. (Uses the 'N' cigar operation to test for
        splicing)
 
---soft-clip-threshold (int)
-       Mappers that soft clip, will sometimes do so rather than mapping a
-       spliced read if there is only a small overhang over the exon
-       junction. By setting this option, you can treat reads with at least
-       this many bases soft-clipped at the 3' end as spliced.
-
 --read-length
       Use the read length as as a criteria when deduping, for e.g sRNA-Seq
 
@@ -144,6 +165,24 @@ very long (>14bp)
       Only consider a fraction of the reads, chosen at random. This is useful
       for doing saturation analyses.
 
+--hash-selection
+      Choose the reads kept by --subset from a hash of the read name
+      seeded with --random-seed rather than at random. The reads chosen
+      then don't depend on the order of the input. UMIs with the same
+      counts are taken in the order they were seen at the position. The
+      directional and cluster methods only use the compiled clustering
+      with --hash-selection or --processes, as it can't reproduce the
+      order of tied UMIs without them
+
+--processes (int)
+      Count in this many processes and write the counts in reference
+      order. The input must be indexed. The contigs are packed into
+      chunks of about the same number of reads from the index, four per
+      process, which the processes take in turn, largest first. The
+      chunks and the time each took are written to the log. Implies
+      --hash-selection so that the reads chosen don't depend on the
+      chunks. Can't be used with --gene-transcript-map. Default is 1
+
 --chrom (string)
       Only consider a single chromosome. This is useful for debugging purposes
 
@@ -199,13 +238,14 @@ Usage
 '''
 import sys
 import collections
+import os
 import re
+import shutil
+import tempfile
 
 # required to make iteritems python2 and python3 compatible
 from builtins import dict
 
-from functools import partial
-
 import pysam
 
 import pandas as pd
@@ -226,6 +266,146 @@ try:
 except ImportError:
     import umi_methods
 
+try:
+    import umi_tools.parallel as parallel
+except ImportError:
+    import parallel
+
+
+def count(inreads, outfile, options, umi_getter, hash_seed=None,
+          buffer_stats=None):
+    ''' count the reads from inreads per gene and write the counts to
+    outfile, updating buffer_stats if given, see
+    umi_methods.get_gene_count. Returns the number of reads counted,
+    the read events and the cluster counts '''
+
+    # with stable ties, or for the neighbour cache, the umis are
+    # interned as integer codes for the run and only decoded on output.
+    # Otherwise tied umis are taken in the order of their sequences, so
+    # interning them would only mean decoding every bundle
+    if (hash_seed is not None or options.neighbour_cache_size > 0 or
+            options.dense_neighbours):
+        umi_interner = network.UMIInterner()
+        umi_code_getter = umi_interner.get_umi_getter(umi_getter)
+    else:
+        umi_interner = None
+        umi_code_getter = umi_getter
+
+    # set up UMIClusterer functor with methods specific to
+    # specified options.method
+    processor = network.UMIClusterer(
+        options.method, interner=umi_interner,
+        cache_size=options.cluster_cache_size,
+        neighbour_cache_size=options.neighbour_cache_size,
+        dense_neighbours=options.dense_neighbours,
+        wildcard=options.wildcard_n,
+        stable_ties=hash_seed is not None)
+
+    nInput, nOutput = 0, 0
+    read_events = collections.Counter()
+
+    for gene, bundle, read_events in umi_methods.get_gene_count(
+            inreads,
+            subset=options.subset,
+            hash_seed=hash_seed,
+            quality_threshold=options.mapping_quality,
+            paired=options.paired,
+            per_contig=options.per_contig,
+            gene_tag=options.gene_tag,
+            skip_regex=options.skip_regex,
+            umi_getter=umi_code_getter,
+            buffer_stats=buffer_stats):
+
+        umis = bundle.keys()
+        counts = {umi: bundle[umi]["count"] for umi in umis}
+
+        nInput += sum(counts.values())
+
+        # group the umis
+        groups = processor(
+            umis,
+            counts,
+            threshold=options.threshold)
+
+        gene_count = len(groups)
+        outfile.write("%s\t%i\n" % (gene, gene_count))
+        nOutput += gene_count
+
+    return nOutput, read_events, network.get_cluster_counts(processor)
+
+
+def count_chunk(args):
+    ''' count the reads in one chunk in a worker process and write the
+    counts to a temporary file. Returns the name of the file, the
+    number of reads counted, the read events, the cluster counts and
+    the buffer stats '''
+
+    options, in_name, regions, out_name, hash_seed = args
+
+    if options.in_sam:
+        in_mode = "r"
+    else:
+        in_mode = "rb"
+
+    infile = pysam.Samfile(in_name, in_mode)
+
+    buffer_stats = collections.Counter()
+
+    with U.openFile(out_name, "w") as outfile:
+        nOutput, read_events, cluster_counts = count(
+            parallel.fetch_chunk(infile, regions), outfile,
+            options, umi_methods.get_umi_getter(options), hash_seed,
+            buffer_stats)
+
+    infile.close()
+
+    return out_name, nOutput, read_events, cluster_counts, buffer_stats
+
+
+def count_chunks(infile, outfile, in_name, options, hash_seed,
+                 buffer_stats=None):
+    ''' count infile in chunks of whole contigs in a pool of
+    options.processes processes and write the counts in reference
+    order. Returns the number of reads counted, the read events and the
+    cluster counts summed across the chunks. buffer_stats, if given, is
+    updated with the max across the chunks '''
+
+    # genes are counted per contig, so contigs are never split
+    chunks = parallel.plan_chunks(
+        infile, options.processes, chrom=options.chrom,
+        split_contigs=False)
+
+    tmpdir = tempfile.mkdtemp()
+    worker_options = parallel.get_worker_options(options)
+    tasks = [(worker_options, in_name, regions,
+              os.path.join(tmpdir, "%i.tsv" % n), hash_seed)
+             for n, (regions, n_reads) in enumerate(chunks)]
+
+    nOutput = 0
+    read_events = collections.Counter()
+    cluster_counts = collections.Counter()
+
+    try:
+        for (chunk_name, chunk_output, chunk_events, chunk_counts,
+             chunk_buffer_stats) in parallel.map_chunks(
+                 count_chunk, tasks, chunks, options.processes):
+
+            with U.openFile(chunk_name) as inf:
+                for line in inf:
+                    outfile.write(line)
+
+            nOutput += chunk_output
+            read_events.update(chunk_events)
+            cluster_counts.update(chunk_counts)
+            if buffer_stats is not None:
+                umi_methods.update_buffer_stats(buffer_stats,
+                                                chunk_buffer_stats)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return nOutput, read_events, cluster_counts
+
 
 def main(argv=None):
     """script main.
@@ -255,11 +435,42 @@ def main(argv=None):
     parser.add_option("--subset", dest="subset", type="float",
                       help="Use only a fraction of reads, specified by subset",
                       default=None)
+    parser.add_option("--hash-selection", dest="hash_selection",
+                      action="store_true",
+                      help="Select reads by a seeded hash of the read name "
+                      "rather than at random, and keep tied UMIs in the "
+                      "order seen. Needed for the directional and cluster "
+                      "methods to use the compiled clustering",
+                      default=False)
+    parser.add_option("--processes", dest="processes", type="int",
+                      default=1,
+                      help="Count in this many processes "
+                           "[default=%default]")
     parser.add_option("--edit-distance-threshold", dest="threshold",
                       type="int",
                       default=1,
                       help="Edit distance theshold at which to join two UMIs"
                            "when clustering. [default=%default]")
+    parser.add_option("--cluster-cache-size", dest="cluster_cache_size",
+                      type="int",
+                      default=0,
+                      help="Number of bundles to cache the clustering of. "
+                           "0 disables the cache [default=%default]")
+    parser.add_option("--neighbour-cache-size", dest="neighbour_cache_size",
+                      type="int",
+                      default=0,
+                      help="Number of UMIs to cache the neighbours of. "
+                           "0 disables the cache [default=%default]")
+    parser.add_option("--dense-neighbour-table", dest="dense_neighbours",
+                      action="store_true",
+                      default=False,
+                      help="Look up UMI neighbours in a table of every "
+                           "possible UMI [default=%default]")
+    parser.add_option("--wildcard-n", dest="wildcard_n",
+                      action="store_true",
+                      default=False,
+                      help="An N in a UMI matches any base "
+                           "[default=%default]")
     parser.add_option("--chrom", dest="chrom", type="string",
                       help="Restrict to one chromosome",
                       default=None)
@@ -328,19 +539,15 @@ def main(argv=None):
         raise ValueError("skip-regex '%s' is not a "
                          "valid regex" % options.skip_regex)
 
-    infile = pysam.Samfile(in_name, in_mode)
+    if options.processes > 1:
+        if options.per_gene and options.gene_transcript_map:
+            raise ValueError("'--processes' and '--gene-transcript-map' "
+                             "options cannot be used together")
 
-    nInput, nOutput = 0, 0
+    infile = pysam.Samfile(in_name, in_mode)
 
     # set the method with which to extract umis from reads
-    if options.get_umi_method == "read_id":
-        umi_getter = partial(
-            umi_methods.get_umi_read_id, sep=options.umi_sep)
-    elif options.get_umi_method == "tag":
-        umi_getter = partial(
-            umi_methods.get_umi_tag, tag=options.umi_tag)
-    else:
-        raise ValueError("Unknown umi extraction method")
+    umi_getter = umi_methods.get_umi_getter(options)
 
     if options.chrom:
         inreads = infile.fetch(reference=options.chrom)
@@ -356,41 +563,42 @@ def main(argv=None):
             inreads = infile.fetch()
             gene_tag = options.gene_tag
 
-    options.stdout.write("%s\t%s\n" % ("gene", "count"))
-    for gene, bundle, read_events in umi_methods.get_gene_count(
-            inreads,
-            subset=options.subset,
-            quality_threshold=options.mapping_quality,
-            paired=options.paired,
-            per_contig=options.per_contig,
-            gene_tag=options.gene_tag,
-            skip_regex=options.skip_regex,
-            umi_getter=umi_getter):
-
-        umis = bundle.keys()
-        counts = {umi: bundle[umi]["count"] for umi in umis}
-
-        nInput += sum(counts.values())
+    # reads are selected by a seeded hash of their names rather than
+    # at random if requested, or if processing in parallel so that the
+    # reads chosen don't depend on the process
+    if options.hash_selection or options.processes > 1:
+        hash_seed = umi_methods.get_hash_seed(options.random_seed)
+    else:
+        hash_seed = None
 
-        # set up UMIClusterer functor with methods specific to
-        # specified options.method
-        processor = network.UMIClusterer(options.method)
+    options.stdout.write("%s\t%s\n" % ("gene", "count"))
 
-        # group the umis
-        groups = processor(
-            umis,
-            counts,
-            threshold=options.threshold)
+    buffer_stats = collections.Counter()
 
-        gene_count = len(groups)
-        options.stdout.write("%s\t%i\n" % (gene, gene_count))
-        nOutput += gene_count
+    if options.processes > 1:
+        nOutput, read_events, cluster_counts = count_chunks(
+            infile, options.stdout, in_name, options, hash_seed,
+            buffer_stats)
+    else:
+        nOutput, read_events, cluster_counts = count(
+            inreads, options.stdout, options, umi_getter, hash_seed,
+            buffer_stats)
 
     # output reads events and benchmark information.
     for event in read_events.most_common():
         U.info("%s: %s" % (event[0], event[1]))
 
     U.info("Number of reads counted: %i" % nOutput)
+    umi_methods.log_buffer_stats(buffer_stats)
+    U.info("Bundles clustered by size tier: %s" % ", ".join(
+        ["%s: %i" % (x, cluster_counts[x])
+         for x in network.CLUSTER_TIERS]))
+    for name in ("Cluster cache", "Neighbour cache"):
+        if (name, "hits") in cluster_counts:
+            U.info("%s: hits: %i, misses: %i, evictions: %i" % (
+                name, cluster_counts[(name, "hits")],
+                cluster_counts[(name, "misses")],
+                cluster_counts[(name, "evictions")]))
 
     U.Stop()
 
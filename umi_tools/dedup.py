@@ -133,6 +133,35 @@ Options
        increased. The default value of 1 works best unless the UMI is
        very long (>14bp)
 
+--cluster-cache-size (int)
+       Cache the groups of up to this many recently clustered bundles
+       and reuse them for bundles with the same UMIs and counts. The
+       cache hits, misses and evictions are written to the log. Runs of
+       small bundles which are clustered in batches with
+       --hash-selection are not cached.
+       The default of 0 disables the cache
+
+--neighbour-cache-size (int)
+       Bundles with more than 10000 UMIs find the neighbours of each
+       UMI in a run-wide cache of the neighbours of up to this many
+       UMIs, rather than from scratch. The cache hits, misses and
+       evictions are written to the log. The UMIs are then held as
+       integer codes for the run, which are decoded for every bundle
+       unless --hash-selection is set. The default of 0 disables the
+       cache
+
+--dense-neighbour-table
+       For UMIs of up to 12 bases and the default edit distance
+       threshold, look up the neighbours of the UMIs in bundles with
+       more than 10000 UMIs in a table of every possible UMI. The table
+       for 12 base UMIs takes 64MB. As for --neighbour-cache-size, the
+       UMIs are held as integer codes for the run
+
+--wildcard-n
+       Treat an N in a UMI, e.g. from extract --quality-filter-mask, as
+       matching any base when comparing UMIs. By default an N is a
+       mismatch like any other base
+
 --paired
        BAM is paired end - output both read pairs. This will also
        force the Use of the template length to determine reads with
@@ -150,6 +179,29 @@ Options
        junction. By setting this option, you can treat reads with at least
        this many bases soft-clipped at the 3' end as spliced.
 
+--bundle-window (int)
+       Reads are buffered until the start of the current read is more
+       than this many bp beyond their position. Must be longer than any
+       soft clip at the 5' end of a read. Default is 1000
+
+--adaptive-bundle-window
+       Grow the window from --bundle-window to the length of the longest
+       read seen so far, including soft clipped bases, where that is
+       longer. The final window and the most reads and positions
+       buffered when reads were output are written to the log, taking
+       the largest across the chunks with --processes
+
+--processes (int)
+       Deduplicate in this many processes and merge the reads back in
+       reference order. The input must be indexed. The bam is cut into
+       chunks of about the same number of reads from the index, four per
+       process, which the processes take in turn, largest first.
+       Contigs are only cut within if reads are bundled by position and
+       not --paired. The chunks and the time each took are written to
+       the log. Implies --hash-selection so that the reads chosen don't
+       depend on the chunks. Can't be used with --gene-transcript-map.
+       Default is 1
+
 --multimapping-detection-method (string, choice)
        If the sam/bam contains tags to identify multimapping reads, you can
        specify for use when selecting the best read at a given loci.
@@ -186,6 +238,18 @@ Options
       Only consider a fraction of the reads, chosen at random. This is useful
       for doing saturation analyses.
 
+--hash-selection
+      Choose the reads kept by --subset, and between duplicate reads of
+      equal mapping quality, from a hash of the read name seeded with
+      --random-seed rather than at random. The reads chosen then don't
+      depend on the order of the input and mates are treated alike.
+      UMIs with the same counts are taken in the order they were seen at
+      the position, so the output doesn't depend on the rest of the bam.
+      The directional and cluster methods only use the compiled
+      clustering, which also clusters runs of small bundles in batches,
+      with --hash-selection or --processes, as it can't reproduce the
+      order of tied UMIs without them
+
 --chrom (string)
       Only consider a single chromosome. This is useful for debugging purposes
 
@@ -248,13 +312,14 @@ Usage
 '''
 import sys
 import collections
+import os
 import re
+import shutil
+import tempfile
 
 # required to make iteritems python2 and python3 compatible
 from builtins import dict
 
-from functools import partial
-
 import pysam
 
 import pandas as pd
@@ -275,6 +340,11 @@ try:
 except ImportError:
     import umi_methods
 
+try:
+    import umi_tools.parallel as parallel
+except ImportError:
+    import parallel
+
 
 def detect_bam_features(bamfile, n_entries=1000):
     ''' read the first n entries in the bam file and identify the tags
@@ -313,6 +383,272 @@ def aggregateStatsDF(stats_df):
     return agg_df
 
 
+class DedupStats:
+    ''' collects the per UMI counts and average edit distances before
+    and after deduplication for --output-stats. The null distances are
+    drawn afterwards for bundles of the same sizes, in the same order,
+    so that bundles can be deduplicated in other processes '''
+
+    def __init__(self):
+        self.pre_df_dict = {"UMI": [], "counts": []}
+        self.post_df_dict = {"UMI": [], "counts": []}
+        self.pre_cluster_stats = []
+        self.post_cluster_stats = []
+        self.cluster_sizes = []
+
+    def add(self, bundle, umis, umi_counts, post_cluster_umis,
+            interner=None):
+        ''' add a bundle and its deduplicated umis, decoding them with
+        interner if they are interned'''
+
+        pre_cluster_umis = list(bundle)
+        if interner is not None:
+            pre_cluster_umis = [interner.decode(x) for x in pre_cluster_umis]
+            umis = [interner.decode(x) for x in umis]
+
+        self.pre_cluster_stats.append(
+            umi_methods.get_average_umi_distance(pre_cluster_umis))
+        self.pre_df_dict['UMI'].extend(pre_cluster_umis)
+        self.pre_df_dict['counts'].extend(
+            [bundle[umi].count for umi in bundle])
+
+        self.post_df_dict['UMI'].extend(umis)
+        self.post_df_dict['counts'].extend(umi_counts)
+        self.post_cluster_stats.append(
+            umi_methods.get_average_umi_distance(post_cluster_umis))
+
+        self.cluster_sizes.append(
+            (len(pre_cluster_umis), len(post_cluster_umis)))
+
+    def update(self, other):
+        ''' add the stats collected for the following bundles '''
+
+        for key in ("UMI", "counts"):
+            self.pre_df_dict[key].extend(other.pre_df_dict[key])
+            self.post_df_dict[key].extend(other.post_df_dict[key])
+        self.pre_cluster_stats.extend(other.pre_cluster_stats)
+        self.post_cluster_stats.extend(other.post_cluster_stats)
+        self.cluster_sizes.extend(other.cluster_sizes)
+
+    def get_null_stats(self, read_gn):
+        ''' return the average distances between umis drawn at random
+        for each bundle before and after deduplication '''
+
+        pre_cluster_stats_null = []
+        post_cluster_stats_null = []
+        for pre_size, post_size in self.cluster_sizes:
+            pre_cluster_stats_null.append(
+                umi_methods.get_average_umi_distance(
+                    read_gn.getUmis(pre_size)))
+            post_cluster_stats_null.append(
+                umi_methods.get_average_umi_distance(
+                    read_gn.getUmis(post_size)))
+
+        return pre_cluster_stats_null, post_cluster_stats_null
+
+
+def deduplicate(inreads, outfile, options, umi_getter, gene_tag,
+                hash_seed=None, stats=None, buffer_stats=None):
+    ''' deduplicate the reads from inreads and write them to outfile,
+    adding each bundle to stats if given and updating buffer_stats if
+    given, see umi_methods.get_bundles. Returns the numbers of reads in
+    and out, the read events and the cluster counts '''
+
+    # with stable ties, or for the neighbour cache, the umis are
+    # interned as integer codes for the run and only decoded on output.
+    # Otherwise tied umis are taken in the order of their sequences, so
+    # interning them would only mean decoding every bundle
+    if (hash_seed is not None or options.neighbour_cache_size > 0 or
+            options.dense_neighbours):
+        umi_interner = network.UMIInterner()
+        umi_code_getter = umi_interner.get_umi_getter(umi_getter)
+    else:
+        umi_interner = None
+        umi_code_getter = umi_getter
+
+    # set up ReadCluster functor with methods specific to
+    # specified options.method
+    processor = network.ReadDeduplicator(
+        options.method, interner=umi_interner,
+        cache_size=options.cluster_cache_size,
+        neighbour_cache_size=options.neighbour_cache_size,
+        dense_neighbours=options.dense_neighbours,
+        wildcard=options.wildcard_n,
+        stable_ties=hash_seed is not None)
+
+    bundles = umi_methods.get_bundles(
+            inreads,
+            ignore_umi=options.ignore_umi,
+            subset=options.subset,
+            hash_seed=hash_seed,
+            quality_threshold=options.mapping_quality,
+            paired=options.paired,
+            spliced=options.spliced,
+            soft_clip_threshold=options.soft,
+            per_contig=options.per_contig,
+            gene_tag=gene_tag,
+            skip_regex=options.skip_regex,
+            whole_contig=options.whole_contig,
+            read_length=options.read_length,
+            detection_method=options.detection_method,
+            umi_getter=umi_code_getter,
+            window=options.bundle_window,
+            adaptive_window=options.adaptive_bundle_window,
+            all_reads=False,
+            return_read2=False,
+            return_unmapped=False,
+            buffer_stats=buffer_stats)
+
+    if options.ignore_umi:
+        bundles = ((bundle, read_events, status, None)
+                   for bundle, read_events, status in bundles)
+    else:
+        # dedup using umis. With stable ties, runs of small bundles are
+        # clustered in batches
+        bundles = processor.batch(bundles, threshold=options.threshold)
+
+    nInput, nOutput = 0, 0
+    read_events = collections.Counter()
+
+    for bundle, read_events, status, deduplicated in bundles:
+
+        nInput += sum([bundle[umi].count for umi in bundle])
+
+        if nOutput % 10000 == 0:
+            U.debug("Outputted %i" % nOutput)
+
+        if nInput % 1000000 == 0:
+            U.debug("Read %i input reads" % nInput)
+
+        if options.ignore_umi:
+            for umi in bundle:
+                nOutput += 1
+                outfile.write(bundle[umi].read)
+
+        else:
+
+            # write out deduped bam
+            reads, umis, umi_counts = deduplicated
+
+            for read in reads:
+                outfile.write(read)
+                nOutput += 1
+
+            if stats is not None:
+                stats.add(bundle, umis, umi_counts,
+                          [umi_getter(x) for x in reads], umi_interner)
+
+    return (nInput, nOutput, read_events,
+            network.get_cluster_counts(processor))
+
+
+def dedup_chunk(args):
+    ''' deduplicate the reads in one chunk in a worker process and
+    write them to a temporary bam. Returns the name of the bam, the
+    numbers of reads in and out, the read events, the cluster counts,
+    the stats, the buffer stats and the reads whose mates were not on
+    the contig '''
+
+    options, in_name, regions, out_name, hash_seed = args
+
+    if options.in_sam:
+        in_mode = "r"
+    else:
+        in_mode = "rb"
+
+    infile = pysam.Samfile(in_name, in_mode)
+    outfile = pysam.Samfile(out_name, "wb0", template=infile)
+
+    if options.paired:
+        outfile = umi_methods.TwoPassPairWriter(infile, outfile)
+
+    if options.stats:
+        stats = DedupStats()
+    else:
+        stats = None
+
+    buffer_stats = collections.Counter()
+
+    nInput, nOutput, read_events, cluster_counts = deduplicate(
+        parallel.fetch_chunk(infile, regions, options.soft), outfile,
+        options, umi_methods.get_umi_getter(options), options.gene_tag,
+        hash_seed, stats, buffer_stats)
+
+    if options.paired:
+        outfile.write_mates()
+        mates = outfile.read1s
+        outfile.outfile.close()
+    else:
+        mates = set()
+        outfile.close()
+
+    infile.close()
+
+    return (out_name, nInput, nOutput, read_events, cluster_counts,
+            stats, buffer_stats, mates)
+
+
+def dedup_chunks(infile, outfile, in_name, options, hash_seed, stats=None,
+                 buffer_stats=None):
+    ''' deduplicate infile in chunks in a pool of options.processes
+    processes and write the reads to outfile in reference order. Returns
+    the numbers of reads in and out, the read events and the cluster
+    counts summed across the chunks. buffer_stats, if given, is updated
+    with the max across the chunks '''
+
+    # contigs are only split if the reads are bundled by position and
+    # mates are found per contig
+    chunks = parallel.plan_chunks(
+        infile, options.processes, chrom=options.chrom,
+        split_contigs=not (options.paired or options.per_contig or
+                           options.whole_contig or options.gene_tag))
+
+    tmpdir = tempfile.mkdtemp()
+    worker_options = parallel.get_worker_options(options)
+    tasks = [(worker_options, in_name, regions,
+              os.path.join(tmpdir, "%i.bam" % n), hash_seed)
+             for n, (regions, n_reads) in enumerate(chunks)]
+
+    nInput, nOutput = 0, 0
+    read_events = collections.Counter()
+    cluster_counts = collections.Counter()
+    mates = set()
+
+    try:
+        for (chunk_name, chunk_input, chunk_output, chunk_events,
+             chunk_counts, chunk_stats, chunk_buffer_stats,
+             chunk_mates) in parallel.map_chunks(
+                 dedup_chunk, tasks, chunks, options.processes):
+
+            chunk_bam = pysam.Samfile(chunk_name, "rb")
+            for read in chunk_bam.fetch(until_eof=True):
+                outfile.write(read)
+            chunk_bam.close()
+            os.unlink(chunk_name)
+
+            nInput += chunk_input
+            nOutput += chunk_output
+            read_events.update(chunk_events)
+            cluster_counts.update(chunk_counts)
+            mates.update(chunk_mates)
+            if stats is not None:
+                stats.update(chunk_stats)
+            if buffer_stats is not None:
+                umi_methods.update_buffer_stats(buffer_stats,
+                                                chunk_buffer_stats)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # mates on other contigs are searched for in one pass at the end
+    if options.paired:
+        pair_writer = umi_methods.TwoPassPairWriter(infile, outfile)
+        pair_writer.read1s = mates
+        pair_writer.search_mates()
+
+    return nInput, nOutput, read_events, cluster_counts
+
+
 def main(argv=None):
     """script main.
 
@@ -347,6 +683,13 @@ def main(argv=None):
     parser.add_option("--subset", dest="subset", type="float",
                       help="Use only a fraction of reads, specified by subset",
                       default=None)
+    parser.add_option("--hash-selection", dest="hash_selection",
+                      action="store_true",
+                      help="Select reads by a seeded hash of the read name "
+                      "rather than at random, and keep tied UMIs in the "
+                      "order seen. Needed for the directional and cluster "
+                      "methods to use the compiled clustering",
+                      default=False)
     parser.add_option("--spliced-is-unique", dest="spliced",
                       action="store_true",
                       help="Treat a spliced read as different to an unspliced"
@@ -357,11 +700,45 @@ def main(argv=None):
                       help="number of bases clipped from 5' end before"
                            "read is counted as spliced [default=%default]",
                       default=4)
+    parser.add_option("--bundle-window", dest="bundle_window",
+                      type="int",
+                      default=1000,
+                      help="bp behind the current read beyond which reads "
+                           "are output [default=%default]")
+    parser.add_option("--adaptive-bundle-window",
+                      dest="adaptive_bundle_window", action="store_true",
+                      default=False,
+                      help="Grow the bundle window to the longest read "
+                           "seen [default=%default]")
+    parser.add_option("--processes", dest="processes", type="int",
+                      default=1,
+                      help="Deduplicate in this many processes "
+                           "[default=%default]")
     parser.add_option("--edit-distance-threshold", dest="threshold",
                       type="int",
                       default=1,
                       help="Edit distance theshold at which to join two UMIs"
                            "when clustering. [default=%default]")
+    parser.add_option("--cluster-cache-size", dest="cluster_cache_size",
+                      type="int",
+                      default=0,
+                      help="Number of bundles to cache the clustering of. "
+                           "0 disables the cache [default=%default]")
+    parser.add_option("--neighbour-cache-size", dest="neighbour_cache_size",
+                      type="int",
+                      default=0,
+                      help="Number of UMIs to cache the neighbours of. "
+                           "0 disables the cache [default=%default]")
+    parser.add_option("--dense-neighbour-table", dest="dense_neighbours",
+                      action="store_true",
+                      default=False,
+                      help="Look up UMI neighbours in a table of every "
+                           "possible UMI [default=%default]")
+    parser.add_option("--wildcard-n", dest="wildcard_n",
+                      action="store_true",
+                      default=False,
+                      help="An N in a UMI matches any base "
+                           "[default=%default]")
     parser.add_option("--chrom", dest="chrom", type="string",
                       help="Restrict to one chromosome",
                       default=None)
@@ -460,6 +837,11 @@ def main(argv=None):
         if not options.gene_transcript_map and not options.gene_tag:
             raise ValueError("--per-gene option requires --gene-transcript-map "
                              "or --gene-tag")
+
+    if options.processes > 1:
+        if options.per_gene and options.gene_transcript_map:
+            raise ValueError("'--processes' and '--gene-transcript-map' "
+                             "options cannot be used together")
     try:
         re.compile(options.skip_regex)
     except re.error:
@@ -469,11 +851,6 @@ def main(argv=None):
     infile = pysam.Samfile(in_name, in_mode)
     outfile = pysam.Samfile(out_name, out_mode, template=infile)
 
-    if options.paired:
-        outfile = umi_methods.TwoPassPairWriter(infile, outfile)
-
-    nInput, nOutput = 0, 0
-
     if options.detection_method:
         bam_features = detect_bam_features(infile.filename)
 
@@ -491,126 +868,62 @@ def main(argv=None):
                             [x for x in bam_features if bam_features[x]])))
 
     # set the method with which to extract umis from reads
-    if options.get_umi_method == "read_id":
-        umi_getter = partial(
-            umi_methods.get_umi_read_id, sep=options.umi_sep)
-    elif options.get_umi_method == "tag":
-        umi_getter = partial(
-            umi_methods.get_umi_tag, tag=options.umi_tag)
-    else:
-        raise ValueError("Unknown umi extraction method")
+    umi_getter = umi_methods.get_umi_getter(options)
 
     if options.stats:
-        # set up arrays to hold stats data
-        stats_pre_df_dict = {"UMI": [], "counts": []}
-        stats_post_df_dict = {"UMI": [], "counts": []}
-        pre_cluster_stats = []
-        post_cluster_stats = []
-        pre_cluster_stats_null = []
-        post_cluster_stats_null = []
-        topology_counts = collections.Counter()
-        node_counts = collections.Counter()
+        # set up to hold stats data
+        stats = DedupStats()
         read_gn = umi_methods.random_read_generator(
             infile.filename, chrom=options.chrom, umi_getter=umi_getter)
-
-    if options.chrom:
-        inreads = infile.fetch(reference=options.chrom)
-        gene_tag = options.gene_tag
     else:
-        if options.per_gene and options.gene_transcript_map:
-            metacontig2contig = umi_methods.getMetaContig2contig(
-                infile, options.gene_transcript_map)
-            metatag = "MC"
-            inreads = umi_methods.metafetcher(infile, metacontig2contig, metatag)
-            gene_tag = metatag
-
-        else:
-            inreads = infile.fetch()
-            gene_tag = options.gene_tag
+        stats = None
 
-    for bundle, read_events, status in umi_methods.get_bundles(
-            inreads,
-            ignore_umi=options.ignore_umi,
-            subset=options.subset,
-            quality_threshold=options.mapping_quality,
-            paired=options.paired,
-            spliced=options.spliced,
-            soft_clip_threshold=options.soft,
-            per_contig=options.per_contig,
-            gene_tag=gene_tag,
-            skip_regex=options.skip_regex,
-            whole_contig=options.whole_contig,
-            read_length=options.read_length,
-            detection_method=options.detection_method,
-            umi_getter=umi_getter,
-            all_reads=False,
-            return_read2=False,
-            return_unmapped=False):
-
-        nInput += sum([bundle[umi]["count"] for umi in bundle])
-
-        if nOutput % 10000 == 0:
-            U.debug("Outputted %i" % nOutput)
-
-        if nInput % 1000000 == 0:
-            U.debug("Read %i input reads" % nInput)
+    # reads are selected by a seeded hash of their names rather than
+    # at random if requested, or if processing in parallel so that the
+    # reads chosen don't depend on the process
+    if options.hash_selection or options.processes > 1:
+        hash_seed = umi_methods.get_hash_seed(options.random_seed)
+    else:
+        hash_seed = None
 
-        if options.stats:
-            # generate pre-dudep stats
-            average_distance = umi_methods.get_average_umi_distance(bundle.keys())
-            pre_cluster_stats.append(average_distance)
-            cluster_size = len(bundle)
-            random_umis = read_gn.getUmis(cluster_size)
-            average_distance_null = umi_methods.get_average_umi_distance(random_umis)
-            pre_cluster_stats_null.append(average_distance_null)
+    buffer_stats = collections.Counter()
 
-        if options.ignore_umi:
-            for umi in bundle:
-                nOutput += 1
-                outfile.write(bundle[umi]["read"])
+    if options.processes > 1:
+        nInput, nOutput, read_events, cluster_counts = dedup_chunks(
+            infile, outfile, in_name, options, hash_seed, stats,
+            buffer_stats)
 
+    else:
+        if options.chrom:
+            inreads = infile.fetch(reference=options.chrom)
+            gene_tag = options.gene_tag
         else:
+            if options.per_gene and options.gene_transcript_map:
+                metacontig2contig = umi_methods.getMetaContig2contig(
+                    infile, options.gene_transcript_map)
+                metatag = "MC"
+                inreads = umi_methods.metafetcher(
+                    infile, metacontig2contig, metatag)
+                gene_tag = metatag
 
-            # set up ReadCluster functor with methods specific to
-            # specified options.method
-            processor = network.ReadDeduplicator(options.method)
-
-            # dedup using umis and write out deduped bam
-            reads, umis, umi_counts = processor(
-                bundle=bundle,
-                threshold=options.threshold)
-
-            for read in reads:
-                outfile.write(read)
-                nOutput += 1
-
-            if options.stats:
-
-                # collect pre-dudupe stats
-                stats_pre_df_dict['UMI'].extend(bundle)
-                stats_pre_df_dict['counts'].extend(
-                    [bundle[UMI]['count'] for UMI in bundle])
-
-                # collect post-dudupe stats
-                post_cluster_umis = [umi_getter(x) for x in reads]
-                stats_post_df_dict['UMI'].extend(umis)
-                stats_post_df_dict['counts'].extend(umi_counts)
+            else:
+                inreads = infile.fetch()
+                gene_tag = options.gene_tag
 
-                average_distance = umi_methods.get_average_umi_distance(post_cluster_umis)
-                post_cluster_stats.append(average_distance)
+        if options.paired:
+            outfile = umi_methods.TwoPassPairWriter(infile, outfile)
 
-                cluster_size = len(post_cluster_umis)
-                random_umis = read_gn.getUmis(cluster_size)
-                average_distance_null = umi_methods.get_average_umi_distance(random_umis)
-                post_cluster_stats_null.append(average_distance_null)
+        nInput, nOutput, read_events, cluster_counts = deduplicate(
+            inreads, outfile, options, umi_getter, gene_tag, hash_seed, stats,
+            buffer_stats)
 
     outfile.close()
 
     if options.stats:
 
         # generate the stats dataframe
-        stats_pre_df = pd.DataFrame(stats_pre_df_dict)
-        stats_post_df = pd.DataFrame(stats_post_df_dict)
+        stats_pre_df = pd.DataFrame(stats.pre_df_dict)
+        stats_post_df = pd.DataFrame(stats.post_df_dict)
 
         # tally the counts per umi per position
         pre_counts = collections.Counter(stats_pre_df["counts"])
@@ -642,6 +955,11 @@ def main(argv=None):
         agg_df.index.name = 'UMI'
         agg_df.to_csv(options.stats + "_per_umi.tsv", sep="\t")
 
+        pre_cluster_stats = stats.pre_cluster_stats
+        post_cluster_stats = stats.post_cluster_stats
+        pre_cluster_stats_null, post_cluster_stats_null = \
+            stats.get_null_stats(read_gn)
+
         # bin distances into integer bins
         max_ed = int(max(map(max, [pre_cluster_stats,
                                    post_cluster_stats,
@@ -682,6 +1000,16 @@ def main(argv=None):
     U.info("%s" % ", ".join(
         ["%s: %s" % (x[0], x[1]) for x in read_events.most_common()]))
     U.info("Number of reads out: %i" % nOutput)
+    umi_methods.log_buffer_stats(buffer_stats)
+    U.info("Bundles clustered by size tier: %s" % ", ".join(
+        ["%s: %i" % (x, cluster_counts[x])
+         for x in network.CLUSTER_TIERS]))
+    for name in ("Cluster cache", "Neighbour cache"):
+        if (name, "hits") in cluster_counts:
+            U.info("%s: hits: %i, misses: %i, evictions: %i" % (
+                name, cluster_counts[(name, "hits")],
+                cluster_counts[(name, "misses")],
+                cluster_counts[(name, "evictions")]))
 
     U.Stop()
 
@@ -107,6 +107,16 @@ https://cgatoxford.wordpress.com/2017/05/18/estimating-the-number-of-true-cell-b
 You can supply the --plot-prefix option to visualise the threshold set
 for true cell barcodes.
 
+Alternatively, the whitelist can be generated with the 'network'
+method (--whitelist-method=network). Here, the cell barcodes are
+grouped using the directional network method. Starting from the most
+abundant, each barcode absorbs the less abundant barcodes within
+--error-correct-threshold which can be explained as errors from it (A
+counts >= (2 * B counts) - 1). The parent barcodes with at least as
+many counts as the barcodes above the knee are whitelisted and the
+barcodes they absorbed are corrected to them. Groups with parents
+below the knee are not cells and their barcodes are filtered out.
+
 Cell barcodes which do not match the whitelist (user-generated or
 automatically generated) can also be optionally corrected using the
 --error-correct-cell option. All UMIs which do not match the whitelist
@@ -253,6 +263,11 @@ def main(argv=None):
                       dest="error_correct_threshold",
                       type="int",
                       help=("Hamming distance allowed for correction"))
+    parser.add_option("--whitelist-method",
+                      dest="whitelist_method", type="choice",
+                      choices=["knee", "network"],
+                      help=("Method to automatically identify the 'true' "
+                            "cell barcodes. Choose from 'knee' or 'network'"))
     parser.add_option("--plot-prefix",
                       dest="plot_prefix", type="string",
                       help=("Prefix for plots to visualise the automated "
@@ -282,6 +297,7 @@ def main(argv=None):
                         blacklist_tsv=None,
                         error_correct_cell=False,
                         error_correct_threshold=1,
+                        whitelist_method="knee",
                         pattern=None,
                         pattern2=None,
                         read2_in=None,
@@ -442,7 +458,8 @@ def main(argv=None):
                 cell_whitelist, error_correct_mappings = umi_methods.getCellWhitelist(
                     cell_barcode_counts,
                     options.error_correct_threshold,
-                    options.plot_prefix)
+                    options.plot_prefix,
+                    options.whitelist_method)
 
             # re-make the reads1s iterator
             read1s = umi_methods.fastqIterate(U.openFile(options.stdin.name))
@@ -173,6 +173,33 @@ Options
        increased. The default value of 1 works best unless the UMI is
        very long (>14bp)
 
+--cluster-cache-size (int)
+       Cache the groups of up to this many recently clustered bundles
+       and reuse them for bundles with the same UMIs and counts. The
+       cache hits, misses and evictions are written to the log. The
+       default of 0 disables the cache
+
+--neighbour-cache-size (int)
+       Bundles with more than 10000 UMIs find the neighbours of each
+       UMI in a run-wide cache of the neighbours of up to this many
+       UMIs, rather than from scratch. The cache hits, misses and
+       evictions are written to the log. The UMIs are then held as
+       integer codes for the run, which are decoded for every bundle
+       unless --hash-selection is set. The default of 0 disables the
+       cache
+
+--dense-neighbour-table
+       For UMIs of up to 12 bases and the default edit distance
+       threshold, look up the neighbours of the UMIs in bundles with
+       more than 10000 UMIs in a table of every possible UMI. The table
+       for 12 base UMIs takes 64MB. As for --neighbour-cache-size, the
+       UMIs are held as integer codes for the run
+
+--wildcard-n
+       Treat an N in a UMI, e.g. from extract --quality-filter-mask, as
+       matching any base when comparing UMIs. By default an N is a
+       mismatch like any other base
+
 --paired
        BAM is paired end - output both read pairs. This will also
        force the use of the template length to determine reads with
@@ -190,6 +217,29 @@ Options
        junction. By setting this option, you can treat reads with at least
        this many bases soft-clipped at the 3' end as spliced.
 
+--bundle-window (int)
+       Reads are buffered until the start of the current read is more
+       than this many bp beyond their position. Must be longer than any
+       soft clip at the 5' end of a read. Default is 1000
+
+--adaptive-bundle-window
+       Grow the window from --bundle-window to the length of the longest
+       read seen so far, including soft clipped bases, where that is
+       longer. The final window and the most reads and positions
+       buffered when reads were output are written to the log, taking
+       the largest across the chunks with --processes
+
+--processes (int)
+       Group in this many processes and write the reads and groups in
+       the order of the chunks they were grouped in, with the groups of
+       each chunk numbered on from those of the chunk before. The input
+       must be indexed. The bam is cut into chunks of about the same
+       number of reads from the index, four per process, which the
+       processes take in turn, largest first. The chunks and the time
+       each took are written to the log. Implies --hash-selection so
+       that the reads chosen don't depend on the chunks. Can't be used
+       with --per-gene. Default is 1
+
 --multimapping-detection-method (string, choice)
        If the sam/bam contains tags to identify multimapping reads, you can
        specify for use when selecting the best read at a given loci.
@@ -203,6 +253,16 @@ Options
       Only consider a fraction of the reads, chosen at random. This is useful
       for doing saturation analyses.
 
+--hash-selection
+      Choose the reads kept by --subset, and between duplicate reads of
+      equal mapping quality, from a hash of the read name seeded with
+      --random-seed rather than at random. The reads chosen then don't
+      depend on the order of the input and mates are treated alike.
+      UMIs with the same counts are taken in the order they were seen at
+      the position. The directional and cluster methods only use the
+      compiled clustering with --hash-selection or --processes, as it
+      can't reproduce the order of tied UMIs without them
+
 --chrom
       Only consider a single chromosome. This is useful for debugging purposes
 
@@ -268,8 +328,9 @@ Usage
 '''
 import sys
 import collections
-
-from functools import partial
+import os
+import shutil
+import tempfile
 
 # required to make iteritems python2 and python3 compatible
 from builtins import dict
@@ -293,6 +354,251 @@ try:
 except ImportError:
     import umi_methods
 
+try:
+    import umi_tools.parallel as parallel
+except ImportError:
+    import parallel
+
+
+def is_single_read(read, paired):
+    ''' return True if get_bundles outputs the read on its own, without
+    a group '''
+
+    return (read.is_read2 or read.is_unmapped or
+            (paired and read.mate_is_unmapped))
+
+
+def group(inreads, outfile, mapping_outfile, options, umi_getter, gene_tag,
+          hash_seed=None, buffer_stats=None):
+    ''' group the reads from inreads, writing them to outfile and the
+    groups to mapping_outfile if given, and update buffer_stats if
+    given, see umi_methods.get_bundles. Returns the numbers of reads in
+    and out, the number of groups, the read events and the cluster
+    counts '''
+
+    # with stable ties, or for the neighbour cache, the umis are
+    # interned as integer codes for the run and only decoded on output.
+    # Otherwise tied umis are taken in the order of their sequences, so
+    # interning them would only mean decoding every bundle
+    if (hash_seed is not None or options.neighbour_cache_size > 0 or
+            options.dense_neighbours):
+        umi_interner = network.UMIInterner()
+        umi_code_getter = umi_interner.get_umi_getter(umi_getter)
+    else:
+        umi_interner = None
+        umi_code_getter = umi_getter
+
+    def decode(umi):
+        if umi_interner is None:
+            return umi
+        return umi_interner.decode(umi)
+
+    # set up UMIClusterer functor with methods specific to
+    # specified options.method
+    processor = network.UMIClusterer(
+        options.method, interner=umi_interner,
+        cache_size=options.cluster_cache_size,
+        neighbour_cache_size=options.neighbour_cache_size,
+        dense_neighbours=options.dense_neighbours,
+        wildcard=options.wildcard_n,
+        stable_ties=hash_seed is not None)
+
+    nInput, nOutput, unique_id = 0, 0, 0
+    read_events = collections.Counter()
+
+    for bundle, read_events, status in umi_methods.get_bundles(
+            inreads,
+            ignore_umi=False,
+            subset=options.subset,
+            hash_seed=hash_seed,
+            quality_threshold=options.mapping_quality,
+            paired=options.paired,
+            spliced=options.spliced,
+            soft_clip_threshold=options.soft,
+            per_contig=options.per_contig,
+            gene_tag=gene_tag,
+            skip_regex=options.skip_regex,
+            read_length=options.read_length,
+            umi_getter=umi_code_getter,
+            window=options.bundle_window,
+            adaptive_window=options.adaptive_bundle_window,
+            all_reads=True,
+            return_read2=True,
+            return_unmapped=options.output_unmapped,
+            buffer_stats=buffer_stats):
+
+        # write out read2s and unmapped if option set
+        if status == 'single_read':
+            # bundle is just a single read here
+            outfile.write(bundle)
+            nInput += 1
+            nOutput += 1
+            continue
+
+        umis = bundle.keys()
+        counts = {umi: bundle[umi].count for umi in umis}
+
+        nInput += sum(counts.values())
+
+        if nOutput % 10000 == 0:
+            U.debug("Outputted %i" % nOutput)
+
+        if nInput % 1000000 == 0:
+            U.debug("Read %i input reads" % nInput)
+
+        # group the umis
+        groups = processor(
+            umis,
+            counts,
+            threshold=options.threshold)
+
+        for umi_group in groups:
+            top_umi = decode(umi_group[0])
+
+            group_count = sum(counts[umi] for umi in umi_group)
+
+            for umi in umi_group:
+                entry = bundle[umi]
+                for read, position in zip(entry.read, entry.positions):
+                    if outfile:
+                        # Add the 'UG' tag to the read
+                        read.tags += [('UG', unique_id)]
+                        read.tags += [(options.umi_group_tag, top_umi)]
+                        outfile.write(read)
+
+                    if options.tsv:
+                        if options.per_gene:
+                            gene = read.get_tag(gene_tag)
+                        else:
+                            gene = "NA"
+                        mapping_outfile.write("%s\n" % "\t".join(map(str, (
+                            read.query_name, read.reference_name,
+                            position,
+                            gene,
+                            decode(umi).decode(),
+                            counts[umi],
+                            top_umi.decode(),
+                            group_count,
+                            unique_id))))
+
+                    nOutput += 1
+
+            unique_id += 1
+
+    return (nInput, nOutput, unique_id, read_events,
+            network.get_cluster_counts(processor))
+
+
+def group_chunk(args):
+    ''' group the reads in one chunk in a worker process, writing them
+    to a temporary bam and the groups to a temporary flatfile, with
+    groups numbered from 0. Returns the names of the files, the numbers
+    of reads in and out, the number of groups, the read events, the
+    cluster counts and the buffer stats '''
+
+    options, in_name, regions, out_name, tsv_name, hash_seed = args
+
+    if options.in_sam:
+        in_mode = "r"
+    else:
+        in_mode = "rb"
+
+    infile = pysam.Samfile(in_name, in_mode)
+
+    if options.output_bam:
+        outfile = pysam.Samfile(out_name, "wb0", template=infile)
+    else:
+        outfile = None
+
+    if options.tsv:
+        mapping_outfile = U.openFile(tsv_name, "w")
+    else:
+        mapping_outfile = None
+
+    buffer_stats = collections.Counter()
+
+    nInput, nOutput, unique_id, read_events, cluster_counts = group(
+        parallel.fetch_chunk(infile, regions, options.soft), outfile,
+        mapping_outfile, options, umi_methods.get_umi_getter(options),
+        options.gene_tag, hash_seed, buffer_stats)
+
+    if outfile:
+        outfile.close()
+
+    if mapping_outfile:
+        mapping_outfile.close()
+
+    infile.close()
+
+    return (out_name, tsv_name, nInput, nOutput, unique_id, read_events,
+            cluster_counts, buffer_stats)
+
+
+def group_chunks(infile, outfile, mapping_outfile, in_name, options,
+                 hash_seed, buffer_stats=None):
+    ''' group infile in chunks in a pool of options.processes processes
+    and write the reads and groups in the order of the chunks, with the
+    groups of each chunk numbered on from those of the last. Returns
+    the numbers of reads in and out, the number of groups, the read
+    events and the cluster counts summed across the chunks. buffer_stats,
+    if given, is updated with the max across the chunks '''
+
+    # contigs are only split if the reads are grouped by position
+    chunks = parallel.plan_chunks(
+        infile, options.processes, chrom=options.chrom,
+        split_contigs=not (options.per_contig or options.gene_tag),
+        unplaced=options.output_unmapped and not options.chrom)
+
+    tmpdir = tempfile.mkdtemp()
+    worker_options = parallel.get_worker_options(options)
+    tasks = [(worker_options, in_name, regions,
+              os.path.join(tmpdir, "%i.bam" % n),
+              os.path.join(tmpdir, "%i.tsv" % n), hash_seed)
+             for n, (regions, n_reads) in enumerate(chunks)]
+
+    nInput, nOutput, unique_id = 0, 0, 0
+    read_events = collections.Counter()
+    cluster_counts = collections.Counter()
+
+    try:
+        for (chunk_name, tsv_name, chunk_input, chunk_output, chunk_groups,
+             chunk_events, chunk_counts,
+             chunk_buffer_stats) in parallel.map_chunks(
+                 group_chunk, tasks, chunks, options.processes):
+
+            if outfile:
+                chunk_bam = pysam.Samfile(chunk_name, "rb")
+                for read in chunk_bam.fetch(until_eof=True):
+                    if not is_single_read(read, options.paired):
+                        read.set_tag('UG', read.get_tag('UG') + unique_id)
+                        # set_tag moves the UG tag to the end, so the
+                        # group tag is set again to keep it after UG
+                        read.set_tag(options.umi_group_tag,
+                                     read.get_tag(options.umi_group_tag))
+                    outfile.write(read)
+                chunk_bam.close()
+
+            if mapping_outfile:
+                with U.openFile(tsv_name) as inf:
+                    for line in inf:
+                        values, chunk_id = line.rstrip("\n").rsplit("\t", 1)
+                        mapping_outfile.write("%s\t%i\n" % (
+                            values, int(chunk_id) + unique_id))
+
+            nInput += chunk_input
+            nOutput += chunk_output
+            unique_id += chunk_groups
+            read_events.update(chunk_events)
+            cluster_counts.update(chunk_counts)
+            if buffer_stats is not None:
+                umi_methods.update_buffer_stats(buffer_stats,
+                                                chunk_buffer_stats)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return nInput, nOutput, unique_id, read_events, cluster_counts
+
 
 def main(argv=None):
     """script main.
@@ -328,6 +634,13 @@ def main(argv=None):
     parser.add_option("--subset", dest="subset", type="float",
                       help="Use only a fraction of reads, specified by subset",
                       default=None)
+    parser.add_option("--hash-selection", dest="hash_selection",
+                      action="store_true",
+                      help="Select reads by a seeded hash of the read name "
+                      "rather than at random, and keep tied UMIs in the "
+                      "order seen. Needed for the directional and cluster "
+                      "methods to use the compiled clustering",
+                      default=False)
     parser.add_option("--spliced-is-unique", dest="spliced",
                       action="store_true",
                       help="Treat a spliced read as different to an unspliced"
@@ -338,11 +651,45 @@ def main(argv=None):
                       help="number of bases clipped from 5' end before"
                            "read is counted as spliced [default=%default]",
                       default=4)
+    parser.add_option("--bundle-window", dest="bundle_window",
+                      type="int",
+                      default=1000,
+                      help="bp behind the current read beyond which reads "
+                           "are output [default=%default]")
+    parser.add_option("--adaptive-bundle-window",
+                      dest="adaptive_bundle_window", action="store_true",
+                      default=False,
+                      help="Grow the bundle window to the longest read "
+                           "seen [default=%default]")
+    parser.add_option("--processes", dest="processes", type="int",
+                      default=1,
+                      help="Group in this many processes "
+                           "[default=%default]")
     parser.add_option("--edit-distance-threshold", dest="threshold",
                       type="int",
                       default=1,
                       help="Edit distance theshold at which to join two UMIs"
                            "when clustering. [default=%default]")
+    parser.add_option("--cluster-cache-size", dest="cluster_cache_size",
+                      type="int",
+                      default=0,
+                      help="Number of bundles to cache the clustering of. "
+                           "0 disables the cache [default=%default]")
+    parser.add_option("--neighbour-cache-size", dest="neighbour_cache_size",
+                      type="int",
+                      default=0,
+                      help="Number of UMIs to cache the neighbours of. "
+                           "0 disables the cache [default=%default]")
+    parser.add_option("--dense-neighbour-table", dest="dense_neighbours",
+                      action="store_true",
+                      default=False,
+                      help="Look up UMI neighbours in a table of every "
+                           "possible UMI [default=%default]")
+    parser.add_option("--wildcard-n", dest="wildcard_n",
+                      action="store_true",
+                      default=False,
+                      help="An N in a UMI matches any base "
+                           "[default=%default]")
     parser.add_option("--chrom", dest="chrom", type="string",
                       help="Restrict to one chromosome",
                       default=None)
@@ -429,6 +776,11 @@ def main(argv=None):
         if not options.gene_transcript_map:
             raise ValueError("--per-gene option requires --gene-transcript-map")
 
+    if options.processes > 1:
+        if options.per_gene:
+            raise ValueError("'--processes' and '--per-gene' "
+                             "options cannot be used together")
+
     infile = pysam.Samfile(in_name, in_mode)
 
     if options.output_bam:
@@ -443,110 +795,46 @@ def main(argv=None):
              "final_umi", "final_umi_count", "unique_id"]))
 
     # set the method with which to extract umis from reads
-    if options.get_umi_method == "read_id":
-        umi_getter = partial(
-            umi_methods.get_umi_read_id, sep=options.umi_sep)
-    elif options.get_umi_method == "tag":
-        umi_getter = partial(
-            umi_methods.get_umi_tag, tag=options.umi_tag)
-    else:
-        raise ValueError("Unknown umi extraction method")
+    umi_getter = umi_methods.get_umi_getter(options)
 
-    nInput, nOutput, unique_id = 0, 0, 0
-
-    if options.chrom:
-        inreads = infile.fetch(reference=options.chrom)
-        gene_tag = options.gene_tag
+    # reads are selected by a seeded hash of their names rather than
+    # at random if requested, or if processing in parallel so that the
+    # reads chosen don't depend on the process
+    if options.hash_selection or options.processes > 1:
+        hash_seed = umi_methods.get_hash_seed(options.random_seed)
     else:
-        if options.per_gene and options.gene_transcript_map:
-            metacontig2contig = umi_methods.getMetaContig2contig(
-                infile, options.gene_transcript_map)
-            metatag = "MC"
-            inreads = umi_methods.metafetcher(infile, metacontig2contig, metatag)
-            gene_tag = metatag
-
-        else:
-            inreads = infile.fetch(until_eof=options.output_unmapped)
-            gene_tag = options.gene_tag
-
-    for bundle, read_events, status in umi_methods.get_bundles(
-            inreads,
-            ignore_umi=False,
-            subset=options.subset,
-            quality_threshold=options.mapping_quality,
-            paired=options.paired,
-            spliced=options.spliced,
-            soft_clip_threshold=options.soft,
-            per_contig=options.per_contig,
-            gene_tag=gene_tag,
-            skip_regex=options.skip_regex,
-            read_length=options.read_length,
-            umi_getter=umi_getter,
-            all_reads=True,
-            return_read2=True,
-            return_unmapped=options.output_unmapped):
-
-        # write out read2s and unmapped if option set
-        if status == 'single_read':
-            # bundle is just a single read here
-            outfile.write(bundle)
-            nInput += 1
-            nOutput += 1
-            continue
-
-        umis = bundle.keys()
-        counts = {umi: bundle[umi]["count"] for umi in umis}
-
-        nInput += sum(counts.values())
-
-        if nOutput % 10000 == 0:
-            U.debug("Outputted %i" % nOutput)
-
-        if nInput % 1000000 == 0:
-            U.debug("Read %i input reads" % nInput)
-
-        # set up UMIClusterer functor with methods specific to
-        # specified options.method
-        processor = network.UMIClusterer(options.method)
-
-        # group the umis
-        groups = processor(
-            umis,
-            counts,
-            threshold=options.threshold)
-
-        for umi_group in groups:
-            top_umi = umi_group[0]
+        hash_seed = None
 
-            group_count = sum(counts[umi] for umi in umi_group)
+    if not options.tsv:
+        mapping_outfile = None
 
-            for umi in umi_group:
-                reads = bundle[umi]['read']
-                for read in reads:
-                    if outfile:
-                        # Add the 'UG' tag to the read
-                        read.tags += [('UG', unique_id)]
-                        read.tags += [(options.umi_group_tag, top_umi)]
-                        outfile.write(read)
+    buffer_stats = collections.Counter()
 
-                    if options.tsv:
-                        if options.per_gene:
-                            gene = read.get_tag(gene_tag)
-                        else:
-                            gene = "NA"
-                        mapping_outfile.write("%s\n" % "\t".join(map(str, (
-                            read.query_name, read.reference_name,
-                            umi_methods.get_read_position(read, options.soft)[1],
-                            gene,
-                            umi.decode(),
-                            counts[umi],
-                            top_umi.decode(),
-                            group_count,
-                            unique_id))))
+    if options.processes > 1:
+        nInput, nOutput, unique_id, read_events, cluster_counts = \
+            group_chunks(infile, outfile, mapping_outfile, in_name, options,
+                         hash_seed, buffer_stats)
 
-                    nOutput += 1
-
-            unique_id += 1
+    else:
+        if options.chrom:
+            inreads = infile.fetch(reference=options.chrom)
+            gene_tag = options.gene_tag
+        else:
+            if options.per_gene and options.gene_transcript_map:
+                metacontig2contig = umi_methods.getMetaContig2contig(
+                    infile, options.gene_transcript_map)
+                metatag = "MC"
+                inreads = umi_methods.metafetcher(
+                    infile, metacontig2contig, metatag)
+                gene_tag = metatag
+
+            else:
+                inreads = infile.fetch(until_eof=options.output_unmapped)
+                gene_tag = options.gene_tag
+
+        nInput, nOutput, unique_id, read_events, cluster_counts = group(
+            inreads, outfile, mapping_outfile, options, umi_getter,
+            gene_tag, hash_seed, buffer_stats)
 
     if outfile:
         outfile.close()
@@ -559,6 +847,16 @@ def main(argv=None):
         ["%s: %s" % (x[0], x[1]) for x in read_events.most_common()]))
     U.info("Number of reads out: %i, Number of groups: %i" %
            (nOutput, unique_id))
+    umi_methods.log_buffer_stats(buffer_stats)
+    U.info("Bundles clustered by size tier: %s" % ", ".join(
+        ["%s: %i" % (x, cluster_counts[x])
+         for x in network.CLUSTER_TIERS]))
+    for name in ("Cluster cache", "Neighbour cache"):
+        if (name, "hits") in cluster_counts:
+            U.info("%s: hits: %i, misses: %i, evictions: %i" % (
+                name, cluster_counts[(name, "hits")],
+                cluster_counts[(name, "misses")],
+                cluster_counts[(name, "evictions")]))
     U.Stop()
 
 if __name__ == "__main__":
@@ -8,25 +8,49 @@ network.py - Network methods for dealing with UMIs
 :Tags: Python UMI
 
 '''
+import array
 import collections
 import itertools
 import sys
-import regex
 import numpy as np
 
 import pyximport
 pyximport.install(build_in_temp=False)
 
 try:
-    from umi_tools._dedup_umi import edit_distance
+    from umi_tools._dedup_umi import edit_distance, edit_distance_wildcard, \
+        encode_umis, hamming_distances, hamming_neighbours, hamming_directional_neighbours, cluster_packed, \
+        cluster_packed_batch
     import umi_tools.Utilities as U
 
 except:
-    from _dedup_umi import edit_distance
+    from _dedup_umi import edit_distance, edit_distance_wildcard, \
+        encode_umis, hamming_distances, hamming_neighbours, hamming_directional_neighbours, cluster_packed, \
+        cluster_packed_batch
     import Utilities as U
 
 sys.setrecursionlimit(10000)
 
+# above this many umis, the packed all-pairs comparison is slower than
+# the segment multi-index
+MAX_PACKED_UMIS = 10000
+
+# umis of up to this length can be looked up in a dense table, see
+# NeighbourCache
+MAX_DENSE_LENGTH = 12
+
+# bundles of up to this many umis are clustered without an adjacency list
+MAX_TRIVIAL_UMIS = 2
+
+# bundles of up to this many umis are clustered in batches of up to
+# BATCH_SIZE bundles by ReadDeduplicator.batch
+MAX_BATCH_UMIS = 32
+BATCH_SIZE = 10000
+
+# the bundle size tiers used by UMIClusterer, see UMIClusterer.__call__
+# and ReadDeduplicator.batch
+CLUSTER_TIERS = ("batched", "trivial", "pairwise", "indexed")
+
 
 def breadth_first_search(node, adj_list):
     searched = set()
@@ -64,6 +88,201 @@ def breadth_first_search_recursive(node, adj_list):
         return breadth_first_search(node, adj_list)
 
 
+def union_find_components(umis, neighbours, counts):
+    ''' return the connected components of the undirected graph where
+    neighbours holds the indices of the neighbours of each umi. The
+    components are built with an array-backed union-find as the edges
+    are read and returned in the same order as a breadth first search
+    from each unseen node in descending count order '''
+
+    parent = list(range(len(umis)))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for node, node_neighbours in enumerate(neighbours):
+        for next_node in node_neighbours:
+            if next_node > node:
+                root1, root2 = find(node), find(next_node)
+                if root1 != root2:
+                    parent[root2] = root1
+
+    root2component = {}
+    components = []
+    for node in sorted(range(len(umis)), key=lambda x: counts[umis[x]],
+                       reverse=True):
+        root = find(node)
+        if root not in root2component:
+            root2component[root] = set()
+            components.append(root2component[root])
+        root2component[root].add(umis[node])
+
+    return components
+
+
+def get_legacy_order(sequences):
+    ''' return the umi sequences in the legacy order of tied umis. The
+    connected components are sets built by breadth_first_search, so
+    without stable ties, umis with the same counts are taken in the
+    order a python set of their sequences iterates in. This depends on
+    the sequences and the order they are added to the set'''
+
+    return list(set(sequences))
+
+
+def get_directional_groups(umis, counts, threshold=1):
+    ''' return the groups of umis found by the directional method, with
+    the parent umi at position 0 of each group. This is intended for
+    very large sets of umis, such as all the cell barcodes observed in
+    a run, so no adjacency lists are built up front.
+
+    The umis are processed in descending count order. Each umi not yet
+    assigned to a group starts a new group and absorbs the unassigned
+    umis reachable from it where the counts of the first umi >=
+    (2 * second umi counts)-1. For the default threshold of 1, the
+    neighbours of a umi are found when it is reached by looking up its
+    substitution variants. Umis of different lengths are never
+    neighbours '''
+
+    umis = sorted(umis, key=lambda x: counts[x], reverse=True)
+    umi_counts = [counts[umi] for umi in umis]
+
+    length2indices = collections.defaultdict(list)
+    for i, umi in enumerate(umis):
+        length2indices[len(umi)].append(i)
+
+    if threshold == 1:
+        umi2index = {umi: i for i, umi in enumerate(umis)}
+        alphabets = {}
+        for length, indices in length2indices.items():
+            alphabets[length] = [set(umis[i][k:k+1] for i in indices)
+                                 for k in range(length)]
+
+        def get_neighbours(node):
+            umi = umis[node]
+            return get_substitution_neighbours(
+                umi, umi2index, alphabets[len(umi)])
+
+    else:
+        neighbours = [None] * len(umis)
+        for indices in length2indices.values():
+            length_neighbours = get_neighbours_multi_index(
+                [umis[i] for i in indices], threshold)
+            for i, umi_neighbours in zip(indices, length_neighbours):
+                neighbours[i] = [indices[j] for j in umi_neighbours]
+
+        get_neighbours = neighbours.__getitem__
+
+    assigned = bytearray(len(umis))
+    groups = []
+    for node in range(len(umis)):
+        if assigned[node]:
+            continue
+
+        assigned[node] = 1
+        group = [node]
+        queue = [node]
+        while queue:
+            parent = queue.pop()
+            for next_node in get_neighbours(parent):
+                if (not assigned[next_node] and
+                    umi_counts[parent] >= (umi_counts[next_node]*2)-1):
+                    assigned[next_node] = 1
+                    group.append(next_node)
+                    queue.append(next_node)
+
+        # umis are in descending count order
+        groups.append([umis[x] for x in sorted(group)])
+
+    return groups
+
+
+def within_one_edit(a, b):
+    ''' return True if a can be converted into b with at most one
+    substitution, insertion or deletion '''
+
+    if len(a) == len(b):
+        return sum(x != y for x, y in zip(a, b)) <= 1
+
+    if len(a) > len(b):
+        a, b = b, a
+
+    if len(b) - len(a) != 1:
+        return False
+
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+
+    return a[i:] == b[i+1:]
+
+
+def get_deletion_neighbourhood(barcode):
+    ''' return the barcode and all the sequences made by deleting one
+    base from it '''
+
+    neighbourhood = set((barcode,))
+    for k in range(len(barcode)):
+        neighbourhood.add(barcode[:k] + barcode[k+1:])
+    return neighbourhood
+
+
+def get_neighbours_fuzzy(barcodes):
+    ''' return, for each barcode, the indices of the barcodes matched
+    by the fuzzy regexes used by CellClusterer:
+
+       "(barcode){e<=1}" - a prefix of the second barcode is within one
+                           substitution, insertion or deletion
+       "(reversed barcode){i<=1}" - a prefix of the second barcode is
+                                    the reversed barcode with at most
+                                    one base inserted
+
+    Rather than running the regexes against every barcode, the
+    deletion neighbourhoods of the prefixes of each barcode which could
+    match are hashed. Any two sequences within one edit share a
+    sequence in their deletion neighbourhoods, so only the barcodes
+    found by looking up the query's neighbourhood need to be checked.
+
+    Each inner list is sorted by barcode index '''
+
+    index = collections.defaultdict(set)
+    for j, barcode in enumerate(barcodes):
+        # a matching prefix is at most two bases shorter than the barcode
+        for m in range(max(0, len(barcode) - 2), len(barcode) + 1):
+            for key in get_deletion_neighbourhood(barcode[:m]):
+                index[key].add(j)
+
+    neighbours = []
+    for i, barcode in enumerate(barcodes):
+        length = len(barcode)
+        reversed_barcode = barcode[::-1]
+
+        candidates = set()
+        for key in get_deletion_neighbourhood(barcode):
+            candidates.update(index.get(key, ()))
+        candidates.update(index.get(reversed_barcode, ()))
+
+        barcode_neighbours = []
+        for j in sorted(candidates):
+            other = barcodes[j]
+            if j == i:
+                continue
+            if any(within_one_edit(barcode, other[:m]) for m in
+                   range(max(0, length - 1), min(len(other), length + 1) + 1)):
+                barcode_neighbours.append(j)
+            elif (other[:length] == reversed_barcode or
+                  (len(other) > length and
+                   within_one_edit(reversed_barcode, other[:length+1]))):
+                barcode_neighbours.append(j)
+
+        neighbours.append(barcode_neighbours)
+
+    return neighbours
+
+
 def remove_umis(adj_list, cluster, nodes):
     '''removes the specified nodes from the cluster and returns
     the remaining nodes '''
@@ -76,6 +295,151 @@ def remove_umis(adj_list, cluster, nodes):
     return cluster - nodes_to_remove
 
 
+def get_neighbours_pairwise(umis, threshold):
+    ''' return, for each umi, the indices of the umis within the hamming
+    distance threshold. Every pair of umis is compared '''
+
+    neighbours = [[] for umi in umis]
+    for (i, umi1), (j, umi2) in itertools.combinations(enumerate(umis), 2):
+        if edit_distance(umi1, umi2) <= threshold:
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+
+    return neighbours
+
+
+def get_neighbours_substitution(umis):
+    ''' return, for each umi, the indices of the umis which differ from
+    it by a single substitution. Instead of comparing every pair, each
+    substitution variant of a umi is looked up in a hash of the
+    bundle's umis. Only the bases observed at a position in the bundle
+    can create a neighbour, so these are the only substitutions made.
+
+    Each inner list is sorted so the neighbours are in the same order
+    as returned by get_neighbours_pairwise '''
+
+    umi2index = {umi: i for i, umi in enumerate(umis)}
+    length = len(umis[0])
+    alphabets = [set(umi[k:k+1] for umi in umis) for k in range(length)]
+
+    neighbours = []
+    for umi in umis:
+        umi_neighbours = get_substitution_neighbours(umi, umi2index, alphabets)
+        umi_neighbours.sort()
+        neighbours.append(umi_neighbours)
+
+    return neighbours
+
+
+def get_substitution_neighbours(umi, umi2index, alphabets):
+    ''' return the indices in umi2index of the umis which differ from
+    umi by a single substitution, using the bases observed at each
+    position (alphabets) as the substitutes '''
+
+    umi_neighbours = []
+    for k in range(len(umi)):
+        prefix, base, suffix = umi[:k], umi[k:k+1], umi[k+1:]
+        for substitute in alphabets[k]:
+            if substitute == base:
+                continue
+            variant = prefix + substitute + suffix
+            if variant in umi2index:
+                umi_neighbours.append(umi2index[variant])
+
+    return umi_neighbours
+
+
+def get_segments(umi, threshold):
+    ''' return the threshold+1 segments of umi used by the multi-index,
+    keyed by the umi length and their position. If the umi is too short
+    to split, every umi of the same length is a candidate neighbour so
+    a single key for the length is returned'''
+
+    length = len(umi)
+    n_segments = threshold + 1
+
+    if length < n_segments:
+        return [(length,)]
+
+    bounds = [(length * k) // n_segments for k in range(n_segments + 1)]
+    return [(length, k, umi[start:end]) for k, (start, end) in
+            enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+def get_neighbours_multi_index(umis, threshold):
+    ''' return, for each umi, the indices of the umis within the hamming
+    distance threshold. Each umi is split into threshold+1 segments and
+    the bundle is indexed by segment value. By the pigeonhole principle,
+    two umis within the threshold must share at least one segment, so
+    only the umis sharing a segment are compared with edit_distance.
+
+    Each inner list is sorted so the neighbours are in the same order
+    as returned by get_neighbours_pairwise '''
+
+    length = len(umis[0])
+    n_segments = threshold + 1
+
+    # segments would be empty, every pair of umis is a candidate
+    if length < n_segments:
+        return get_neighbours_pairwise(umis, threshold)
+
+    bounds = [(length * k) // n_segments for k in range(n_segments + 1)]
+    segments = list(zip(bounds[:-1], bounds[1:]))
+
+    index = collections.defaultdict(list)
+    for i, umi in enumerate(umis):
+        for k, (start, end) in enumerate(segments):
+            index[(k, umi[start:end])].append(i)
+
+    neighbours = [[] for umi in umis]
+    for i, umi in enumerate(umis):
+        candidates = set()
+        for k, (start, end) in enumerate(segments):
+            candidates.update(index[(k, umi[start:end])])
+
+        for j in candidates:
+            if j > i and edit_distance(umi, umis[j]) <= threshold:
+                neighbours[i].append(j)
+                neighbours[j].append(i)
+
+    for umi_neighbours in neighbours:
+        umi_neighbours.sort()
+
+    return neighbours
+
+
+def get_neighbours_directional(umis, counts, threshold, encode=encode_umis,
+                               wildcard=False):
+    ''' return, for each umi, the indices of the umis within the hamming
+    distance threshold which it can absorb, i.e where the counts of the
+    first umi >= (2 * second umi counts)-1. The umis are sorted by count
+    so that each umi is only compared with the umis whose count is low
+    enough to be absorbed. Returns None if the umis can't be packed by
+    encode. If wildcard is set, an N matches any base
+
+    Each inner list is sorted so the neighbours are in the same order
+    as returned by get_neighbours_pairwise '''
+
+    order = sorted(range(len(umis)), key=lambda x: counts[umis[x]])
+
+    packed_umis = encode([umis[i] for i in order])
+    if packed_umis is None:
+        return None
+
+    codes, masks = packed_umis
+    sorted_counts = np.array([counts[umis[i]] for i in order],
+                             dtype=np.int64)
+
+    sorted_neighbours = hamming_directional_neighbours(
+        codes, masks, sorted_counts, threshold, wildcard)
+
+    neighbours = [None] * len(umis)
+    for i, umi_neighbours in zip(order, sorted_neighbours):
+        neighbours[i] = sorted(order[j] for j in umi_neighbours)
+
+    return neighbours
+
+
 class CellClusterer:
     '''A functor that clusters a dictionary of cell barcodes and their counts.
     The primary return value is either a list of representative UMIs
@@ -92,8 +456,13 @@ class CellClusterer:
         sorted_nodes = sorted(cluster, key=lambda x: counts[x],
                               reverse=True)
 
+        # remove the nodes accounted for by each lead node in turn,
+        # rather than recomputing them for every prefix of sorted_nodes
+        remaining = set(cluster)
         for i in range(len(sorted_nodes) - 1):
-            if len(remove_umis(adj_list, cluster, sorted_nodes[:i+1])) == 0:
+            remaining.discard(sorted_nodes[i])
+            remaining.difference_update(adj_list[sorted_nodes[i]])
+            if len(remaining) == 0:
                 return sorted_nodes[:i+1]
 
     def _get_adj_list_directional(self, umis, counts):
@@ -103,21 +472,15 @@ class CellClusterer:
         adj_list = {umi: [] for umi in umis}
 
         if self.fuzzy_match:
-            for umi1 in umis:
-                # we need a second regex for some insertions,
-                # e.g UMI1 = "ATCG", UMI2 = "ATTC"
-                comp_regex_err = regex.compile("(%s){e<=1}" % str(umi1))
-                comp_regex_del = regex.compile("(%s){i<=1}" % str(umi1)[::-1])
-                for umi2 in umis:
-                    if umi1 == umi2:
-                        continue
+            umis = list(umis)
+            neighbours = get_neighbours_fuzzy(umis)
+            for umi1, umi1_neighbours in zip(umis, neighbours):
+                for umi2 in (umis[j] for j in umi1_neighbours):
                     if counts[umi1] >= (counts[umi2]*self.dir_threshold):
                         if (max(len(umi1), len(umi2)) -
                             min(len(umi1), len(umi2))) > 1:
                             continue
-                        if (comp_regex_err.match(str(umi2)) or
-                            comp_regex_del.match(str(umi2))):
-                            adj_list[umi1].append(umi2)
+                        adj_list[umi1].append(umi2)
         else:
             for umi1, umi2 in itertools.combinations(umis, 2):
                 if edit_distance(umi1, umi2) <= 1:
@@ -142,6 +505,23 @@ class CellClusterer:
                 components.append(component)
         return components
 
+    def _group_directional(self, clusters, adj_list, counts):
+        ''' return groups for directional method'''
+
+        observed = set()
+        groups = []
+        for cluster in clusters:
+            cluster = sorted(cluster, key=lambda x: counts[x], reverse=True)
+            # need to remove any node which has already been observed
+            temp_cluster = []
+            for node in cluster:
+                if node not in observed:
+                    temp_cluster.append(node)
+                    observed.add(node)
+            groups.append(temp_cluster)
+
+        return groups
+
     def __init__(self, cluster_method="directional",
                  dir_threshold=10, fuzzy_match=True):
         ''' select the required class methods for the cluster_method
@@ -153,6 +533,7 @@ class CellClusterer:
         if cluster_method == "directional":
             self.get_adj_list = self._get_adj_list_directional
             self.get_connected_components = self._get_connected_components_adjacency
+            self.get_groups = self._group_directional
         else:
             raise ValueError("CellClusterer currently only supports the directional method")
 
@@ -166,7 +547,7 @@ class CellClusterer:
 
         adj_list = self.get_adj_list(umis, counts)
 
-        clusters = self.get_connected_components(umis, adj_list, counts)
+        clusters = self.get_connected_components(adj_list, counts)
 
         final_umis = [list(x) for x in
                       self.get_groups(clusters, adj_list, counts)]
@@ -174,6 +555,314 @@ class CellClusterer:
         return final_umis
 
 
+class UMIInterner:
+    '''A run-wide table which interns each distinct UMI as a compact
+    integer code, assigned in the order the UMIs are first seen. Bundles
+    can then be keyed by the codes rather than by a fresh bytes object
+    for every read, and the UMIs are only decoded on output.
+
+    Where the UMI can be packed, the packed UMI is stored alongside the
+    code so bundles of codes can be clustered without re-encoding the
+    UMIs for every bundle.
+
+      ** __call__ ** - returns the code for a UMI, adding it if unseen
+
+      ** decode ** - returns the UMI for a code
+
+      ** encode ** - returns the packed UMIs for a list of codes
+
+      ** get_umi_getter ** - wraps a umi getter to return codes
+    '''
+
+    def __init__(self):
+
+        self.umi2code = {}
+        self.umis = []
+
+        # the length of each packed umi, or -1 if it can't be packed
+        self.packed_lengths = array.array("i")
+        self.packed_codes = array.array("Q")
+        self.packed_masks = array.array("Q")
+
+    def __call__(self, umi):
+        ''' return the code for umi, adding it to the table if unseen'''
+
+        try:
+            return self.umi2code[umi]
+        except KeyError:
+            code = len(self.umis)
+            self.umi2code[umi] = code
+            self.umis.append(umi)
+
+            packed_umi = encode_umis([umi])
+            if packed_umi is None:
+                self.packed_lengths.append(-1)
+                self.packed_codes.append(0)
+                self.packed_masks.append(0)
+            else:
+                self.packed_lengths.append(len(umi))
+                self.packed_codes.append(int(packed_umi[0][0]))
+                self.packed_masks.append(int(packed_umi[1][0]))
+
+            return code
+
+    def __len__(self):
+        return len(self.umis)
+
+    def decode(self, code):
+        ''' return the umi for code'''
+        return self.umis[code]
+
+    def encode(self, codes):
+        ''' return the packed umis for a list of codes, as returned by
+        encode_umis, or None if they can't be packed'''
+
+        if len(codes) == 0:
+            return None
+
+        codes = np.fromiter(codes, dtype=np.intp, count=len(codes))
+
+        lengths = self.get_packed_lengths(codes)
+        if lengths.min() < 0 or lengths.min() != lengths.max():
+            return None
+
+        return self.get_packed(codes)
+
+    def get_packed_lengths(self, codes):
+        ''' return the lengths of the packed umis for an array of codes,
+        which are -1 where the umi can't be packed'''
+        return np.frombuffer(self.packed_lengths, dtype=np.int32)[codes]
+
+    def get_packed(self, codes):
+        ''' return the packed umis for an array of codes, without
+        checking they can be packed or are the same length'''
+        return (np.frombuffer(self.packed_codes, dtype=np.uint64)[codes],
+                np.frombuffer(self.packed_masks, dtype=np.uint64)[codes])
+
+    def get_umi_getter(self, umi_getter):
+        ''' return a function which gets the code of the umi of a read
+        using umi_getter. The compiled getters in umi_methods look the
+        codes up themselves'''
+
+        if hasattr(umi_getter, "with_interner"):
+            return umi_getter.with_interner(self)
+
+        def get_umi_code(read):
+            return self(umi_getter(read))
+
+        return get_umi_code
+
+
+class LRUCache:
+    '''A bounded least recently used cache, which counts the hits,
+    misses and evictions'''
+
+    def __init__(self, max_size):
+
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ''' return the value for key, or None if it isn't cached'''
+
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # re-insert to mark as most recently used
+        self.cache[key] = value
+        self.hits += 1
+        return value
+
+    def add(self, key, value):
+        ''' cache value, evicting the least recently used value if the
+        cache is full'''
+
+        self.cache[key] = value
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+
+class NeighbourCache:
+    '''A run-wide cache of the neighbours of interned UMIs, i.e the codes
+    of the UMIs seen so far within the edit distance threshold. Bundles
+    share many UMIs, so the neighbours of each UMI in a bundle are
+    looked up and filtered to those in the bundle, rather than found
+    from scratch for every bundle.
+
+    For the default threshold of 1, the neighbours of a UMI are found by
+    looking up its substitution variants in the interner. For larger
+    thresholds, a segment multi-index of all the UMIs seen is used.
+    Each entry records how many UMIs had been seen when it was found
+    and is found again if the bundle holds a UMI seen since. Up to
+    max_size entries are cached, the least recently used are evicted
+    first.
+
+    If dense is set, UMIs of up to MAX_DENSE_LENGTH bases are looked
+    up in a table mapping every possible packed UMI to its code instead,
+    which finds the neighbours of a whole bundle at once. This is for
+    the threshold of 1 and bundles without Ns. The table for UMIs of
+    MAX_DENSE_LENGTH bases takes 64MB'''
+
+    def __init__(self, interner, max_size, dense=False):
+
+        self.interner = interner
+        self.cache = LRUCache(max_size)
+        self.dense = dense
+
+        # the bases observed at each position, per umi length
+        self.alphabets = {}
+        self.alphabets_upto = 0
+
+        # segment multi-indexes of the umis seen, per threshold and length
+        self.segment_indexes = collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        self.segment_indexes_upto = collections.defaultdict(int)
+
+        # dense tables of the packed umis seen, per length
+        self.dense_tables = {}
+        self.dense_tables_upto = 0
+
+    def _update_alphabets(self):
+        ''' add the umis interned since the last update to the alphabets'''
+
+        for umi in self.interner.umis[self.alphabets_upto:]:
+            if len(umi) not in self.alphabets:
+                self.alphabets[len(umi)] = [set() for k in range(len(umi))]
+            for k, alphabet in enumerate(self.alphabets[len(umi)]):
+                alphabet.add(umi[k:k+1])
+
+        self.alphabets_upto = len(self.interner)
+
+    def _update_segment_index(self, threshold):
+        ''' add the umis interned since the last update to the segment
+        multi-index for threshold'''
+
+        index = self.segment_indexes[threshold]
+        start = self.segment_indexes_upto[threshold]
+
+        for code, umi in enumerate(self.interner.umis[start:], start):
+            for segment in get_segments(umi, threshold):
+                index[segment].append(code)
+
+        self.segment_indexes_upto[threshold] = len(self.interner)
+
+    def _update_dense_tables(self):
+        ''' add the umis interned since the last update to the dense
+        tables'''
+
+        start, end = self.dense_tables_upto, len(self.interner)
+        codes = np.arange(start, end, dtype=np.intp)
+        lengths = self.interner.get_packed_lengths(codes)
+        packed_codes, packed_masks = self.interner.get_packed(codes)
+
+        for length in np.unique(lengths).tolist():
+            if length < 0 or length > MAX_DENSE_LENGTH:
+                continue
+            if length not in self.dense_tables:
+                self.dense_tables[length] = np.full(4 ** length, -1,
+                                                    dtype=np.int32)
+            dense = (lengths == length) & (packed_masks == 0)
+            self.dense_tables[length][packed_codes[dense]] = codes[dense]
+
+        self.dense_tables_upto = end
+
+    def _find_neighbours(self, code, threshold):
+        ''' return the codes of the umis seen so far within threshold of
+        the umi for code'''
+
+        umi = self.interner.decode(code)
+
+        if threshold == 1:
+            return get_substitution_neighbours(
+                umi, self.interner.umi2code, self.alphabets[len(umi)])
+
+        index = self.segment_indexes[threshold]
+        candidates = set()
+        for segment in get_segments(umi, threshold):
+            candidates.update(index[segment])
+
+        return [x for x in candidates if x != code and
+                edit_distance(umi, self.interner.decode(x)) <= threshold]
+
+    def _get_neighbours_dense(self, umis):
+        ''' return the neighbours of the umis at threshold 1 using the
+        dense tables, or None if the umis can't be looked up'''
+
+        packed_umis = self.interner.encode(umis)
+        if packed_umis is None:
+            return None
+
+        codes, masks = packed_umis
+        length = len(self.interner.decode(umis[0]))
+        if length > MAX_DENSE_LENGTH or masks.any():
+            return None
+
+        if self.dense_tables_upto < len(self.interner):
+            self._update_dense_tables()
+
+        # the codes of the substitution variants of each umi
+        substitutions = np.array(
+            [x << (2 * k) for k in range(length) for x in (1, 2, 3)],
+            dtype=np.uint64)
+        variants = self.dense_tables[length][
+            codes[:, np.newaxis] ^ substitutions[np.newaxis, :]]
+
+        # keep the variants in the bundle, as their index in the bundle
+        umis = np.asarray(umis, dtype=np.int64)
+        umi_order = np.argsort(umis)
+        positions = np.searchsorted(umis, variants, sorter=umi_order)
+        positions = umi_order[np.minimum(positions, len(umis) - 1)]
+        in_bundle = umis[positions] == variants
+
+        rows, columns = np.nonzero(in_bundle)
+        indices = positions[rows, columns]
+        row_order = np.lexsort((indices, rows))
+        indices = indices[row_order].tolist()
+        ends = np.cumsum(in_bundle.sum(axis=1)).tolist()
+
+        return [indices[start:end]
+                for start, end in zip([0] + ends[:-1], ends)]
+
+    def get_neighbours(self, umis, threshold):
+        ''' return, for each umi code, the indices of the umis within
+        the threshold, in ascending order'''
+
+        if self.dense and threshold == 1:
+            neighbours = self._get_neighbours_dense(umis)
+            if neighbours is not None:
+                return neighbours
+
+        if threshold == 1:
+            if self.alphabets_upto < len(self.interner):
+                self._update_alphabets()
+        elif self.segment_indexes_upto[threshold] < len(self.interner):
+            self._update_segment_index(threshold)
+
+        umi2index = {umi: i for i, umi in enumerate(umis)}
+        newest_umi = max(umis)
+
+        neighbours = []
+        for umi in umis:
+            entry = self.cache.get((umi, threshold))
+            if entry is None or entry[0] <= newest_umi:
+                entry = (len(self.interner),
+                         self._find_neighbours(umi, threshold))
+                self.cache.add((umi, threshold), entry)
+
+            neighbours.append(sorted(umi2index[x] for x in entry[1]
+                                     if x in umi2index))
+
+        return neighbours
+
+
 class UMIClusterer:
     '''A functor that clusters a dictionary of UMIs and their counts.
     The primary return value is either a list of representative UMIs
@@ -201,6 +890,9 @@ class UMIClusterer:
     all custering methods. Where there are not required, the methods return
     None or the input parameters.
 
+    Note: The compiled clustering routine is only used with stable_ties,
+    see __init__. By default the python methods are used.
+
     '''
 
     # "get_best" methods #
@@ -213,8 +905,13 @@ class UMIClusterer:
         sorted_nodes = sorted(cluster, key=lambda x: counts[x],
                               reverse=True)
 
+        # remove the nodes accounted for by each lead node in turn,
+        # rather than recomputing them for every prefix of sorted_nodes
+        remaining = set(cluster)
         for i in range(len(sorted_nodes) - 1):
-            if len(remove_umis(adj_list, cluster, sorted_nodes[:i+1])) == 0:
+            remaining.discard(sorted_nodes[i])
+            remaining.difference_update(adj_list[sorted_nodes[i]])
+            if len(remaining) == 0:
                 return sorted_nodes[:i+1]
 
     def _get_best_percentile(self, cluster, counts):
@@ -227,33 +924,245 @@ class UMIClusterer:
             threshold = np.median(list(counts.values()))/100
             return [read for read in cluster if counts[read] > threshold]
 
+    # "get_neighbours" method #
+
+    def _get_neighbours(self, umis, threshold):
+        ''' return the indices of the neighbours of each umi. Bundles of
+        up to MAX_PACKED_UMIS are compared all-pairs using the packed
+        umis. Larger bundles are indexed'''
+
+        if len(umis) <= MAX_PACKED_UMIS:
+            packed_umis = self.encode(umis)
+            if packed_umis is not None:
+                codes, masks = packed_umis
+                return hamming_neighbours(codes, masks, threshold,
+                                          self.wildcard)
+
+        if self.wildcard:
+            return self._get_neighbours_wildcard(umis, threshold)
+        else:
+            return self._get_neighbours_indexed(umis, threshold)
+
+    def _get_neighbours_wildcard(self, umis, threshold):
+        ''' return the indices of the neighbours of each umi, where an N
+        matches any base. The umis without an N are indexed as usual and
+        each umi with an N is then compared with the whole bundle, so
+        the cost grows with the number of umis with an N'''
+
+        if self.interner is None:
+            sequences = umis
+        else:
+            sequences = [self.interner.decode(x) for x in umis]
+
+        masked = [i for i, umi in enumerate(sequences) if b"N" in umi]
+        if len(masked) == 0:
+            return self._get_neighbours_indexed(umis, threshold)
+
+        is_masked = bytearray(len(umis))
+        for i in masked:
+            is_masked[i] = 1
+        unmasked = [i for i in range(len(umis)) if not is_masked[i]]
+
+        neighbours = [[] for umi in umis]
+        if len(unmasked) > 0:
+            unmasked_neighbours = self._get_neighbours_indexed(
+                [umis[i] for i in unmasked], threshold)
+            for i, umi_neighbours in zip(unmasked, unmasked_neighbours):
+                neighbours[i] = [unmasked[j] for j in umi_neighbours]
+
+        packed_umis = self.encode(umis)
+        for i in masked:
+            if packed_umis is not None:
+                codes, masks = packed_umis
+                distances = hamming_distances(codes[i], masks[i], codes, masks,
+                                              True)
+                candidates = np.nonzero(distances <= threshold)[0].tolist()
+            else:
+                candidates = [j for j, umi in enumerate(sequences) if
+                              edit_distance_wildcard(sequences[i], umi) <=
+                              threshold]
+
+            # umis with an N are compared with each other once
+            for j in candidates:
+                if j != i and (not is_masked[j] or j > i):
+                    neighbours[i].append(j)
+                    neighbours[j].append(i)
+
+        for umi_neighbours in neighbours:
+            umi_neighbours.sort()
+
+        return neighbours
+
+    def _get_neighbours_indexed(self, umis, threshold):
+        ''' return the indices of the neighbours of each umi using the
+        neighbour cache if there is one, else the substitution hash for
+        the default threshold of 1 and the segment multi-index
+        otherwise'''
+
+        if self.neighbour_cache is not None:
+            return self.neighbour_cache.get_neighbours(umis, threshold)
+
+        if self.interner is not None:
+            umis = [self.interner.decode(x) for x in umis]
+
+        if threshold == 1:
+            return get_neighbours_substitution(umis)
+        elif threshold > 1:
+            return get_neighbours_multi_index(umis, threshold)
+        else:
+            return get_neighbours_pairwise(umis, threshold)
+
+    # "cluster" methods #
+
+    def _cluster_pair(self, umis, counts, threshold):
+        ''' return the groups for a bundle of two umis without building
+        an adjacency list'''
+
+        umi1, umi2 = sorted(umis, key=lambda x: counts[x], reverse=True)
+
+        if self.interner is None:
+            sequence1, sequence2 = umi1, umi2
+        else:
+            sequence1 = self.interner.decode(umi1)
+            sequence2 = self.interner.decode(umi2)
+
+        distance = self.edit_distance(sequence1, sequence2)
+
+        if (distance > threshold or
+            (self.directional and counts[umi1] < (counts[umi2]*2)-1)):
+            return [[umi1], [umi2]]
+
+        # as in larger bundles, tied umis are taken in the legacy order
+        # unless the ties are stable
+        if (self.stable_ties or counts[umi1] != counts[umi2] or
+                get_legacy_order((sequence1, sequence2))[0] == sequence1):
+            return [[umi1, umi2]]
+        else:
+            return [[umi2, umi1]]
+
+    def _cluster_compiled(self, umis, counts, threshold):
+        ''' return the groups found by the compiled clustering routine,
+        or None if the umis can't be packed '''
+
+        umis = sorted(umis, key=lambda x: counts[x], reverse=True)
+
+        packed_umis = self.encode(umis)
+        if packed_umis is None:
+            return None
+
+        codes, masks = packed_umis
+        umi_counts = np.array([counts[umi] for umi in umis], dtype=np.int64)
+
+        order, offsets = cluster_packed(codes, masks, umi_counts, threshold,
+                                        self.directional, self.wildcard)
+        order, offsets = order.tolist(), offsets.tolist()
+
+        return [[umis[x] for x in order[start:end]]
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+    # "cluster_batch" method #
+
+    def cluster_batch(self, umis, counts, bundle_sizes, threshold):
+        ''' cluster many bundles of interned umis in a single call to
+        the compiled clustering routine. umis and counts are the codes
+        and counts of the umis of all the bundles, in order, and
+        bundle_sizes the number of umis in each bundle.
+
+        Returns, for each bundle, the parent umis and the total counts of
+        their groups, or None for bundles which can't be packed. These
+        bundles need to be clustered by calling the clusterer '''
+
+        umis = np.asarray(umis, dtype=np.intp)
+        counts = np.asarray(counts, dtype=np.int64)
+        bundle_sizes = np.asarray(bundle_sizes, dtype=np.intp)
+        bundle_starts = np.cumsum(bundle_sizes) - bundle_sizes
+
+        lengths = self.interner.get_packed_lengths(umis)
+        min_lengths = np.minimum.reduceat(lengths, bundle_starts)
+        packable = ((min_lengths >= 0) &
+                    (min_lengths == np.maximum.reduceat(lengths,
+                                                        bundle_starts)))
+
+        if not packable.any():
+            return [None] * len(bundle_sizes)
+        elif not packable.all():
+            packable_umis = np.repeat(packable, bundle_sizes)
+            umis, counts = umis[packable_umis], counts[packable_umis]
+            bundle_sizes = bundle_sizes[packable]
+
+        # sort the umis of each bundle by descending count, keeping ties
+        # in their order in the bundle
+        bundle_ids = np.repeat(np.arange(len(bundle_sizes)), bundle_sizes)
+        umi_order = np.lexsort((-counts, bundle_ids))
+        umis, counts = umis[umi_order], counts[umi_order]
+
+        codes, masks = self.interner.get_packed(umis)
+        bundle_offsets = np.zeros(len(bundle_sizes) + 1, dtype=np.intp)
+        np.cumsum(bundle_sizes, out=bundle_offsets[1:])
+
+        order, group_offsets, bundle_group_offsets = cluster_packed_batch(
+            codes, masks, counts, bundle_offsets, threshold,
+            self.directional, self.wildcard)
+
+        parents = umis[order[group_offsets[:-1]]].tolist()
+        group_counts = np.add.reduceat(counts[order],
+                                       group_offsets[:-1]).tolist()
+        bundle_group_offsets = bundle_group_offsets.tolist()
+
+        self.tier_counts["batched"] += len(bundle_sizes)
+
+        clustered = iter(zip(bundle_group_offsets[:-1],
+                             bundle_group_offsets[1:]))
+        results = []
+        for bundle_packable in packable.tolist():
+            if bundle_packable:
+                start, end = next(clustered)
+                results.append((parents[start:end], group_counts[start:end]))
+            else:
+                results.append(None)
+
+        return results
+
     # "get_adj_list" methods #
 
     def _get_adj_list_adjacency(self, umis, counts, threshold):
         ''' identify all umis within hamming distance threshold'''
 
-        adj_list = {umi: [] for umi in umis}
-        for umi1, umi2 in itertools.combinations(umis, 2):
-            if edit_distance(umi1, umi2) <= threshold:
-                adj_list[umi1].append(umi2)
-                adj_list[umi2].append(umi1)
+        umis = list(umis)
+        neighbours = self._get_neighbours(umis, threshold)
 
-        return adj_list
+        return {umi: [umis[j] for j in umi_neighbours]
+                for umi, umi_neighbours in zip(umis, neighbours)}
 
     def _get_adj_list_directional(self, umis, counts, threshold=1):
         ''' identify all umis within the hamming distance threshold
         and where the counts of the first umi is > (2 * second umi counts)-1'''
 
-        adj_list = {umi: [] for umi in umis}
-        for umi1, umi2 in itertools.combinations(umis, 2):
-            if edit_distance(umi1, umi2) <= threshold:
-                if counts[umi1] >= (counts[umi2]*2)-1:
-                    adj_list[umi1].append(umi2)
-                if counts[umi2] >= (counts[umi1]*2)-1:
-                    adj_list[umi2].append(umi1)
+        umis = list(umis)
+
+        # the substitution hash is already linear in the number of umis
+        if threshold != 1 and len(umis) <= MAX_PACKED_UMIS:
+            neighbours = get_neighbours_directional(umis, counts, threshold,
+                                                    self.encode, self.wildcard)
+            if neighbours is not None:
+                return {umi: [umis[j] for j in umi_neighbours]
+                        for umi, umi_neighbours in zip(umis, neighbours)}
+
+        neighbours = self._get_neighbours(umis, threshold)
+
+        adj_list = {}
+        for umi, umi_neighbours in zip(umis, neighbours):
+            adj_list[umi] = [umis[j] for j in umi_neighbours
+                             if counts[umi] >= (counts[umis[j]]*2)-1]
 
         return adj_list
 
+    def _get_adj_list_neighbours(self, umis, counts, threshold):
+        ''' return the indices of the umis within hamming distance
+        threshold of each umi, without building an adjacency dictionary'''
+
+        return self._get_neighbours(list(umis), threshold)
+
     def _get_adj_list_null(self, umis, counts, threshold):
         ''' for methods which don't use a adjacency dictionary'''
         return None
@@ -282,6 +1191,11 @@ class UMIClusterer:
                 components.append(component)
         return components
 
+    def _get_connected_components_union_find(self, umis, neighbours, counts):
+        ''' find the connected UMIs from the neighbour indices'''
+
+        return union_find_components(list(umis), neighbours, counts)
+
     def _get_connected_components_null(self, umis, adj_list, counts):
         ''' for methods which don't use a adjacency dictionary'''
         return umis
@@ -336,9 +1250,15 @@ class UMIClusterer:
                 observed.update(lead_umis)
 
                 for lead_umi in lead_umis:
-                    connected_nodes = set(adj_list[lead_umi])
-                    groups.append([lead_umi] +
-                                  list(connected_nodes - observed))
+                    if self.stable_ties:
+                        connected_nodes = adj_list[lead_umi]
+                        groups.append([lead_umi] +
+                                      [x for x in connected_nodes
+                                       if x not in observed])
+                    else:
+                        connected_nodes = set(adj_list[lead_umi])
+                        groups.append([lead_umi] +
+                                      list(connected_nodes - observed))
                     observed.update(connected_nodes)
 
         return groups
@@ -364,8 +1284,57 @@ class UMIClusterer:
 
         return groups
 
-    def __init__(self, cluster_method="directional"):
-        ''' select the required class methods for the cluster_method'''
+    def __init__(self, cluster_method="directional", compiled=True,
+                 interner=None, cache_size=0, neighbour_cache_size=0,
+                 dense_neighbours=False, wildcard=False,
+                 stable_ties=False):
+        ''' select the required class methods for the cluster_method.
+        The compiled clustering routine is opt-in via stable_ties: only
+        with stable_ties do the directional and cluster methods use it,
+        unless compiled is False. Without stable_ties, the default, the
+        python methods below are used throughout, as the compiled
+        routine can't take tied UMIs in the order of a python set. If a
+        UMIInterner is given, the UMIs are the integer codes from the
+        interner. If cache_size is set, the groups of up to this many
+        recently clustered bundles are cached. With an interner,
+        neighbour_cache_size and dense_neighbours set up a
+        NeighbourCache for the bundles too large to compare all-pairs.
+        If wildcard is set, an N in a UMI matches any base. If
+        stable_ties is set, UMIs with the same counts are taken in the
+        order of the bundle, rather than the order of their sequences
+        in a set'''
+
+        if cache_size > 0:
+            self.cache = LRUCache(cache_size)
+        else:
+            self.cache = None
+
+        if interner is not None and (neighbour_cache_size > 0 or
+                                     dense_neighbours):
+            self.neighbour_cache = NeighbourCache(
+                interner, neighbour_cache_size, dense_neighbours)
+        else:
+            self.neighbour_cache = None
+
+        self.stable_ties = stable_ties
+
+        self.wildcard = wildcard
+        if wildcard:
+            self.edit_distance = edit_distance_wildcard
+        else:
+            self.edit_distance = edit_distance
+
+        self.interner = interner
+        if interner is None:
+            self.encode = encode_umis
+        else:
+            self.encode = interner.encode
+
+        self.compiled = (compiled and stable_ties and
+                         cluster_method in ("directional", "cluster"))
+        self.directional = cluster_method == "directional"
+        self.pairs = cluster_method in ("adjacency", "directional", "cluster")
+        self.tier_counts = collections.Counter()
 
         if cluster_method == "adjacency":
             self.get_adj_list = self._get_adj_list_adjacency
@@ -378,8 +1347,15 @@ class UMIClusterer:
             self.get_groups = self._group_directional
 
         elif cluster_method == "cluster":
-            self.get_adj_list = self._get_adj_list_adjacency
-            self.get_connected_components = self._get_connected_components_adjacency
+            # the union-find components are sets built in a different
+            # order to those from the breadth first search, which changes
+            # the order of tied umis unless the ties are stable
+            if stable_ties:
+                self.get_adj_list = self._get_adj_list_neighbours
+                self.get_connected_components = self._get_connected_components_union_find
+            else:
+                self.get_adj_list = self._get_adj_list_adjacency
+                self.get_connected_components = self._get_connected_components_adjacency
             self.get_groups = self._group_cluster
 
         elif cluster_method == "percentile":
@@ -396,15 +1372,85 @@ class UMIClusterer:
     def __call__(self, umis, counts, threshold):
         '''Counts is a directionary that maps UMIs to their counts'''
 
-        len_umis = [len(x) for x in umis]
+        if self.cache is None:
+            return self._cluster(umis, counts, threshold)
+
+        # the groups only depend on the umis, in order, their counts and
+        # the threshold
+        umis = list(umis)
+        key = (tuple(umis), tuple([counts[umi] for umi in umis]), threshold)
+
+        groups = self.cache.get(key)
+        if groups is None:
+            groups = tuple(tuple(x) for x in
+                           self._cluster(umis, counts, threshold))
+            self.cache.add(key, groups)
+
+        return [list(x) for x in groups]
+
+    def _cluster_sequences(self, umis, adj_list, counts):
+        ''' return the groups for interned umis, found with the umis
+        decoded. The legacy order of tied umis (see get_legacy_order)
+        depends on their sequences, so this keeps it for interned umis'''
+
+        umis = list(umis)
+        sequences = [self.interner.decode(x) for x in umis]
+        codes = dict(zip(sequences, umis))
+        decoded = dict(zip(umis, sequences))
+
+        counts = {sequence: counts[umi]
+                  for umi, sequence in zip(umis, sequences)}
+        adj_list = {decoded[umi]: [decoded[x] for x in neighbours]
+                    for umi, neighbours in adj_list.items()}
+
+        clusters = self.get_connected_components(sequences, adj_list, counts)
+
+        return [[codes[x] for x in group] for group in
+                self.get_groups(clusters, adj_list, counts)]
+
+    def _cluster(self, umis, counts, threshold):
+        ''' return the groups for the umis'''
+
+        if self.interner is None:
+            len_umis = [len(x) for x in umis]
+        else:
+            len_umis = [len(self.interner.decode(x)) for x in umis]
         assert max(len_umis) == min(len_umis), (
             "not all umis are the same length(!):  %d - %d" % (
                 min(len_umis), max(len_umis)))
 
+        # bundles are dispatched by size. One or two umis need no
+        # adjacency list, bundles of up to MAX_PACKED_UMIS are compared
+        # all-pairs and larger bundles use the neighbour indexes
+        if len(umis) <= MAX_TRIVIAL_UMIS:
+            self.tier_counts["trivial"] += 1
+            if len(umis) == 1:
+                return [list(umis)]
+            elif self.pairs:
+                return self._cluster_pair(umis, counts, threshold)
+
+        elif len(umis) <= MAX_PACKED_UMIS:
+            self.tier_counts["pairwise"] += 1
+            if self.compiled:
+                final_umis = self._cluster_compiled(umis, counts, threshold)
+                if final_umis is not None:
+                    return final_umis
+
+        else:
+            self.tier_counts["indexed"] += 1
+
         adj_list = self.get_adj_list(umis, counts, threshold)
 
+        if (self.interner is not None and self.pairs and
+                not self.stable_ties):
+            return self._cluster_sequences(umis, adj_list, counts)
+
         clusters = self.get_connected_components(umis, adj_list, counts)
 
+        if self.stable_ties and self.pairs:
+            order = {umi: n for n, umi in enumerate(umis)}
+            clusters = [sorted(x, key=order.__getitem__) for x in clusters]
+
         final_umis = [list(x) for x in
                       self.get_groups(clusters, adj_list, counts)]
 
@@ -417,9 +1463,22 @@ class ReadDeduplicator:
     taking a read bundle, extracting the UMIs and Counts, running UMIClusterer
     and returning the results along with annotated reads'''
 
-    def __init__(self, cluster_method="directional"):
-
-        self.UMIClusterer = UMIClusterer(cluster_method=cluster_method)
+    def __init__(self, cluster_method="directional", interner=None,
+                 cache_size=0, neighbour_cache_size=0,
+                 dense_neighbours=False, wildcard=False,
+                 stable_ties=False):
+
+        self.UMIClusterer = UMIClusterer(
+            cluster_method=cluster_method,
+            interner=interner,
+            cache_size=cache_size,
+            neighbour_cache_size=neighbour_cache_size,
+            dense_neighbours=dense_neighbours,
+            wildcard=wildcard,
+            stable_ties=stable_ties)
+        self.tier_counts = self.UMIClusterer.tier_counts
+        self.cache = self.UMIClusterer.cache
+        self.neighbour_cache = self.UMIClusterer.neighbour_cache
 
     def __call__(self, bundle, threshold):
         '''Process the the bundled reads according to the method specified
@@ -434,13 +1493,94 @@ class ReadDeduplicator:
         '''
 
         umis = bundle.keys()
-        counts = {umi: bundle[umi]["count"] for umi in umis}
+        counts = {umi: bundle[umi].count for umi in umis}
 
         clusters = self.UMIClusterer(umis, counts, threshold)
 
         final_umis = [cluster[0] for cluster in clusters]
         umi_counts = [sum(counts[umi] for umi in cluster)
                       for cluster in clusters]
-        reads = [bundle[umi]["read"] for umi in final_umis]
+        reads = [bundle[umi].read for umi in final_umis]
 
         return (reads, final_umis, umi_counts)
+
+    def _deduplicate_batch(self, batch, threshold):
+        ''' deduplicate a list of (bundle, read_events, status) using
+        UMIClusterer.cluster_batch'''
+
+        if len(batch) == 0:
+            return
+
+        umis, counts = [], []
+        for bundle, read_events, status in batch:
+            for umi, umi_info in bundle.items():
+                umis.append(umi)
+                counts.append(umi_info.count)
+
+        results = self.UMIClusterer.cluster_batch(
+            umis, counts, [len(x[0]) for x in batch], threshold)
+
+        for (bundle, read_events, status), result in zip(batch, results):
+            if result is None:
+                yield (bundle, read_events, status, self(bundle, threshold))
+            else:
+                final_umis, umi_counts = result
+                reads = [bundle[umi].read for umi in final_umis]
+                yield (bundle, read_events, status,
+                       (reads, final_umis, umi_counts))
+
+    def batch(self, bundles, threshold):
+        ''' deduplicate an iterable of (bundle, read_events, status), as
+        returned by umi_methods.get_bundles, and yield each with the
+        return value of __call__ for the bundle appended.
+
+        Runs of bundles of up to MAX_BATCH_UMIS umis are deduplicated in
+        batches of up to BATCH_SIZE bundles with a single call to the
+        compiled clustering routine. This needs the umis to be interned,
+        stable ties and the directional or cluster method. The bundles
+        are yielded in the order they are read'''
+
+        if not (self.UMIClusterer.compiled and
+                self.UMIClusterer.interner is not None):
+            for bundle, read_events, status in bundles:
+                yield (bundle, read_events, status, self(bundle, threshold))
+            return
+
+        batch = []
+        for bundle, read_events, status in bundles:
+            if len(bundle) <= MAX_BATCH_UMIS:
+                batch.append((bundle, read_events, status))
+                if len(batch) == BATCH_SIZE:
+                    for deduplicated in self._deduplicate_batch(
+                            batch, threshold):
+                        yield deduplicated
+                    batch = []
+            else:
+                for deduplicated in self._deduplicate_batch(
+                        batch, threshold):
+                    yield deduplicated
+                batch = []
+                yield (bundle, read_events, status, self(bundle, threshold))
+
+        for deduplicated in self._deduplicate_batch(batch, threshold):
+            yield deduplicated
+
+
+def get_cluster_counts(processor):
+    ''' return the number of bundles clustered by each tier and the
+    hits, misses and evictions of the caches, which can be summed
+    across processes '''
+
+    cluster_counts = collections.Counter(processor.tier_counts)
+
+    caches = [("Cluster cache", processor.cache)]
+    if processor.neighbour_cache is not None:
+        caches.append(("Neighbour cache", processor.neighbour_cache.cache))
+
+    for name, cache in caches:
+        if cache is not None:
+            cluster_counts[(name, "hits")] = cache.hits
+            cluster_counts[(name, "misses")] = cache.misses
+            cluster_counts[(name, "evictions")] = cache.evictions
+
+    return cluster_counts
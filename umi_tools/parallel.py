@@ -0,0 +1,337 @@
+'''
+parallel.py - Methods for processing a BAM in chunks in parallel
+=========================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+A BAM is planned as chunks of roughly equal numbers of reads, from the
+counts of reads per contig in the index. With split_contigs, contigs
+with more reads than a chunk are cut into regions of equal size in the
+compressed BAM, from the linear index of a .bai. Each read belongs to
+the region holding the position it is bundled at, so the reads of a
+bundle are never split between regions.
+
+'''
+import copy
+import itertools
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+
+import pyximport
+pyximport.install(build_in_temp=False)
+
+try:
+    import umi_tools.Utilities as U
+except ImportError:
+    import Utilities as U
+
+try:
+    from umi_tools._bundles import get_read_position
+except ImportError:
+    from _bundles import get_read_position
+
+# each process is planned this many chunks, so that a process which
+# finishes early can take a chunk from one still working
+CHUNKS_PER_PROCESS = 4
+
+# reads are fetched this many bp either side of a region, so that reads
+# bundled in the region are found despite soft clipping at their 5' end
+REGION_MARGIN = 10000
+
+# the size of the windows of the linear index of a .bai, and the bin
+# which holds the offsets of the start and end of a contig
+LINEAR_INDEX_SHIFT = 14
+PSEUDO_BIN = 37450
+
+
+def get_linear_index(bamfile):
+    ''' return the offsets into the compressed bam of the 16kb windows
+    of each contig, and of the end of the contig, from the .bai. Returns
+    None if there is no .bai '''
+
+    filename = bamfile.filename
+    if isinstance(filename, bytes):
+        filename = filename.decode()
+
+    index_filenames = [filename + ".bai",
+                       os.path.splitext(filename)[0] + ".bai"]
+    if bamfile.index_filename:
+        index_filenames.insert(0, bamfile.index_filename)
+
+    for index_filename in index_filenames:
+        if os.path.exists(index_filename):
+            break
+    else:
+        return None
+
+    with open(index_filename, "rb") as inf:
+        data = inf.read()
+
+    if data[:4] != b"BAI\1":
+        return None
+
+    n_ref, = struct.unpack_from("<i", data, 4)
+    offset = 8
+    linear_index = []
+    for tid in range(n_ref):
+        n_bin, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        ref_end = 0
+        for i in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+            if bin_id == PSEUDO_BIN:
+                ref_end, = struct.unpack_from("<Q", data, offset + 16)
+            offset += 8 + n_chunk * 16
+
+        n_intv, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        ioffsets = np.frombuffer(data, dtype="<u8", count=n_intv,
+                                 offset=offset)
+        offset += n_intv * 8
+
+        # windows before the first read of the contig are left at 0
+        if len(ioffsets) and ioffsets[0] == 0:
+            ioffsets = np.where(
+                ioffsets == 0, ioffsets[np.argmax(ioffsets > 0)], ioffsets)
+
+        # the pseudo-bin holds the offset of the end of the contig
+        linear_index.append(
+            np.append(ioffsets, np.uint64(ref_end)).astype("<u8"))
+
+    # a virtual offset is the offset of a bgzf block in the compressed
+    # bam and an offset into the up to 64kb of the uncompressed block.
+    # The size of each block is taken from the offset of the next
+    blocks = np.unique(np.concatenate(linear_index) >> 16)
+    sizes = np.diff(blocks)
+    if len(sizes):
+        sizes = np.append(sizes, np.median(sizes))
+    else:
+        sizes = np.ones(1)
+
+    for tid, ioffsets in enumerate(linear_index):
+        block_offsets = ioffsets >> 16
+        block_sizes = sizes[np.searchsorted(blocks, block_offsets)]
+        offsets = block_offsets + (
+            ioffsets & 0xffff) / float(1 << 16) * block_sizes
+
+        # windows overlapped by long reads start at an earlier offset
+        linear_index[tid] = np.maximum.accumulate(offsets)
+
+    return linear_index
+
+
+def split_contig(contig, offsets, n_regions):
+    ''' split a contig into n_regions regions of about the same size in
+    the compressed bam. Returns the regions with the fraction of the
+    contig in each '''
+
+    if len(offsets) < 2 or offsets[-1] == offsets[0] or n_regions < 2:
+        return [((contig, None, None), 1.0)]
+
+    size = offsets[-1] - offsets[0]
+
+    targets = offsets[0] + size * np.arange(1, n_regions) / n_regions
+    windows = np.unique(np.searchsorted(offsets, targets))
+    windows = windows[(windows > 0) & (windows < len(offsets) - 1)]
+
+    starts = [None] + [int(x) << LINEAR_INDEX_SHIFT for x in windows]
+    ends = starts[1:] + [None]
+    bounds = [0] + list(windows) + [len(offsets) - 1]
+
+    regions = []
+    for n, (start, end) in enumerate(zip(starts, ends)):
+        fraction = float(
+            offsets[bounds[n + 1]] - offsets[bounds[n]]) / size
+        regions.append(((contig, start, end), fraction))
+
+    return regions
+
+
+def plan_chunks(bamfile, processes, chrom=None, split_contigs=True,
+                unplaced=False):
+    ''' plan chunks of about the same number of reads for processes
+    processes. Each chunk is a list of regions in reference order, as
+    (contig, start, end) with start and end None for a whole contig.
+    Returns the chunks with their estimated number of reads.
+
+    chrom: only plan this contig
+
+    split_contigs: split contigs with more reads than a chunk. Only
+    safe if reads are bundled by position
+
+    unplaced: add a region for the unmapped reads without a position
+    '''
+
+    if not bamfile.has_index():
+        raise ValueError("Processing in parallel requires an indexed bam")
+
+    contigs = [(stats.contig, stats.total)
+               for stats in bamfile.get_index_statistics()
+               if stats.total > 0 and (not chrom or stats.contig == chrom)]
+
+    units = []
+    if unplaced and not chrom and bamfile.nocoordinate:
+        units.append((("*", None, None), bamfile.nocoordinate))
+
+    total = sum(n for contig, n in contigs) + sum(n for unit, n in units)
+    target = max(1, total // (processes * CHUNKS_PER_PROCESS))
+
+    if split_contigs:
+        linear_index = get_linear_index(bamfile)
+    else:
+        linear_index = None
+
+    contig_units = []
+    for contig, n in contigs:
+        if linear_index is not None and n > target:
+            offsets = linear_index[bamfile.get_tid(contig)]
+            contig_units.extend(
+                (region, int(n * fraction)) for region, fraction in
+                split_contig(contig, offsets, int(round(float(n) / target))))
+        else:
+            contig_units.append(((contig, None, None), n))
+
+    # pack the regions into chunks in reference order, starting a new
+    # chunk before a region which would take the chunk further over
+    # the target than it is under
+    chunks = []
+    regions, n_reads = [], 0
+    for region, n in contig_units + units:
+        if regions and n_reads + n - target > target - n_reads:
+            chunks.append((regions, n_reads))
+            regions, n_reads = [], 0
+
+        regions.append(region)
+        n_reads += n
+        if n_reads >= target:
+            chunks.append((regions, n_reads))
+            regions, n_reads = [], 0
+
+    if regions:
+        chunks.append((regions, n_reads))
+
+    U.info("Planned %i chunks of about %i reads for %i processes from "
+           "%i reads in the index" % (len(chunks), target, processes, total))
+
+    return chunks
+
+
+def get_worker_options(options):
+    ''' return a copy of the options without the open files, which
+    can't be passed to the worker processes '''
+
+    worker_options = copy.copy(options)
+    for attr in ("stdin", "stdout", "stderr", "stdlog"):
+        setattr(worker_options, attr, None)
+
+    return worker_options
+
+
+def get_chunk_name(regions):
+    ''' return a description of the regions of a chunk for the log '''
+
+    names = []
+    for contig, start, end in regions:
+        if start is None and end is None:
+            names.append(contig)
+        else:
+            names.append("%s:%s-%s" % (
+                contig, start or 0, "" if end is None else end))
+
+    if len(names) > 3:
+        names = names[:2] + ["...", names[-1]]
+
+    return ",".join(names)
+
+
+def fetch_region(bamfile, region, soft_clip_threshold=4):
+    ''' fetch the reads which belong to a region. A read belongs to the
+    region holding the position it is bundled at, or its start if it
+    is unmapped, so reads near the boundary of two regions are only
+    fetched for one of them '''
+
+    contig, start, end = region
+
+    if start is None and end is None:
+        for read in bamfile.fetch(contig):
+            yield read
+        return
+
+    fetch_start = max(0, (start or 0) - REGION_MARGIN)
+    if end is None:
+        fetch_end = None
+    else:
+        fetch_end = end + REGION_MARGIN
+
+    for read in bamfile.fetch(contig, fetch_start, fetch_end):
+
+        if read.is_unmapped:
+            pos = read.reference_start
+        else:
+            pos = get_read_position(read, soft_clip_threshold)[1]
+
+        if start is not None and pos < start:
+            continue
+        if end is not None and pos >= end:
+            continue
+
+        yield read
+
+
+def fetch_chunk(bamfile, regions, soft_clip_threshold=4):
+    ''' fetch the reads which belong to each region of a chunk '''
+
+    return itertools.chain.from_iterable(
+        fetch_region(bamfile, region, soft_clip_threshold)
+        for region in regions)
+
+
+def _call_timed(args):
+    ''' call func on task, returning the index of the task, the result
+    and how long it took '''
+
+    func, index, task = args
+    start = time.time()
+    result = func(task)
+    return index, result, time.time() - start
+
+
+def map_chunks(func, tasks, chunks, processes):
+    ''' call func on the task for each chunk in a pool of processes,
+    yielding the results in the order of the chunks. The chunks are
+    queued largest first and each process takes the next chunk from
+    the queue when it finishes one. The time taken by each chunk is
+    logged '''
+
+    order = sorted(range(len(tasks)), key=lambda x: -chunks[x][1])
+    queue = [(func, index, tasks[index]) for index in order]
+
+    pool = multiprocessing.Pool(processes)
+
+    results = {}
+    next_index = 0
+    try:
+        for index, result, runtime in pool.imap_unordered(
+                _call_timed, queue, chunksize=1):
+
+            regions, n_reads = chunks[index]
+            U.info("Chunk %i of %i, %s, about %i reads: %.2fs" % (
+                index + 1, len(chunks), get_chunk_name(regions), n_reads,
+                runtime))
+
+            results[index] = result
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
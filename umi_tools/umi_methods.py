@@ -11,6 +11,7 @@ umi_methods.py - Methods for dealing with UMIs
 
 import itertools
 import collections
+import heapq
 import random
 import numpy as np
 import pysam
@@ -30,9 +31,28 @@ except:
     import Utilities as U
 
 try:
-    from umi_tools._dedup_umi import edit_distance
+    import umi_tools.network as network
 except:
-    from _dedup_umi import edit_distance
+    import network
+
+try:
+    from umi_tools._bundles import BundleEntry, count_buffered, \
+        group_entries, get_read_hash, get_hash_fraction, \
+        get_bundles as get_bundles_compiled, ReadIdUMIGetter, TagUMIGetter
+    # get_read_position was defined here and get_read_key is its
+    # companion, both are kept importable from umi_methods
+    from umi_tools._bundles import get_read_position, get_read_key
+except:
+    from _bundles import BundleEntry, count_buffered, \
+        group_entries, get_read_hash, get_hash_fraction, \
+        get_bundles as get_bundles_compiled, ReadIdUMIGetter, TagUMIGetter
+    from _bundles import get_read_position, get_read_key
+
+try:
+    from umi_tools._dedup_umi import edit_distance, encode_umis, \
+        hamming_distances
+except:
+    from _dedup_umi import edit_distance, encode_umis, hamming_distances
 
 RANGES = {
     'phred33': (33, 77),
@@ -216,20 +236,40 @@ def getErrorCorrectMappings(cell_barcodes, whitelist, threshold=1):
 
     whitelist = set([str(x).encode("utf-8") for x in whitelist])
 
+    # where the barcodes can be packed, compare each barcode to the
+    # whole whitelist in a single call
+    whitelist_list = list(whitelist)
+    packed_whitelist = encode_umis(whitelist_list)
+
     for cell_barcode in cell_barcodes:
         match = None
         barcode_in_bytes = str(cell_barcode).encode("utf-8")
-        for white_cell in whitelist:
 
-            if barcode_in_bytes in whitelist:  # don't check if whitelisted
-                continue
+        if barcode_in_bytes in whitelist:  # don't check if whitelisted
+            continue
 
-            if edit_distance(barcode_in_bytes, white_cell) <= threshold:
-                if match is not None:  # already matched one barcode
-                    match = None  # set match back to None
-                    break  # break and don't add to maps
-                else:
-                    match = white_cell.decode("utf-8")
+        packed_barcode = None
+        if (packed_whitelist is not None and
+            len(barcode_in_bytes) == len(whitelist_list[0])):
+            packed_barcode = encode_umis([barcode_in_bytes])
+
+        if packed_barcode is not None:
+            codes, masks = packed_whitelist
+            distances = hamming_distances(
+                packed_barcode[0][0], packed_barcode[1][0], codes, masks)
+            matches = np.flatnonzero(distances <= threshold)
+            if len(matches) == 1:  # exclude barcodes matching >1 barcode
+                match = whitelist_list[matches[0]].decode("utf-8")
+
+        else:
+            for white_cell in whitelist:
+
+                if edit_distance(barcode_in_bytes, white_cell) <= threshold:
+                    if match is not None:  # already matched one barcode
+                        match = None  # set match back to None
+                        break  # break and don't add to maps
+                    else:
+                        match = white_cell.decode("utf-8")
 
         if match is not None:
             false_to_true[cell_barcode] = match
@@ -238,39 +278,70 @@ def getErrorCorrectMappings(cell_barcodes, whitelist, threshold=1):
     return false_to_true, true_to_false
 
 
-# TS: This is not being used since the network methods are not
-# appropriate to identify cell barcodes as they currently stand
+def getNetworkEstimate(cell_barcode_counts, threshold=1,
+                       plotfile_prefix=None):
+    ''' Use the directional network method to identify the true cell
+    barcodes. The barcodes are grouped in descending count order, with
+    the parent of each group absorbing the barcodes within the threshold
+    which can be explained as errors from it. The parent barcodes with
+    at least as many counts as the barcodes above the knee (see
+    getKneeEstimate) are the true barcodes and the remaining barcodes in
+    their groups are mapped to them
 
-# def getNetworkEstimate(cell_barcode_counts):
-#     ''' Use the directional network method to identify the true cell
-#     barcodes '''
+    input:
+         cell_barcode_counts = dict(key = barcode, value = count)
+         threshold = edit distance threshold for the network edges
+         plotfile_prefix = (optional) prefix for the knee plots
 
-#     clusterer = network.UMIClusterer("directional")
-#     barcode_groups = clusterer(
-#         [bytes(x, encoding="utf-8") for x in cell_barcode_counts.keys()],
-#         {bytes(x, encoding="utf-8"): y for x, y in cell_barcode_counts.items()},
-#         1)
+    returns:
+         List of true barcodes, (false_to_true, true_to_false) where the
+         mappings are as per getErrorCorrectMappings
+    '''
 
-#     false_to_true = {}
-#     true_to_false = collections.defaultdict(set)
+    knee_barcodes = getKneeEstimate(cell_barcode_counts, plotfile_prefix)
+    if knee_barcodes is None:
+        raise ValueError(
+            "Could not find the knee of the cell barcode counts, which "
+            "sets the minimum count for the network method")
+    min_count = min(cell_barcode_counts[x] for x in knee_barcodes)
 
-#     true_barcodes = []
-#     for group in barcode_groups:
-#         true_barcode = group[0].decode("utf-8")
-#         true_barcodes.append(true_barcode)
-#         if len(group) > 1:
-#             error_barcodes = group[1:]
-#             for error_barcode in error_barcodes:
-#                 error_barcode = error_barcode.decode("utf-8")
-#                 false_to_true[error_barcode] = true_barcode
-#                 true_to_false[true_barcode].add(error_barcode)
+    barcode_groups = network.get_directional_groups(
+        list(cell_barcode_counts.keys()), cell_barcode_counts, threshold)
 
-#     return true_barcodes, (false_to_true, true_to_false)
+    false_to_true = {}
+    true_to_false = collections.defaultdict(set)
+
+    true_barcodes = set()
+    for group in barcode_groups:
+        true_barcode = group[0]
+        if cell_barcode_counts[true_barcode] < min_count:
+            continue
+        true_barcodes.add(true_barcode)
+        for error_barcode in group[1:]:
+            false_to_true[error_barcode] = true_barcode
+            true_to_false[true_barcode].add(error_barcode)
+
+    U.info("%i cell barcodes collapsed into %i groups, of which %i with "
+           "at least %i counts are true cell barcodes" % (
+               len(cell_barcode_counts), len(barcode_groups),
+               len(true_barcodes), min_count))
+
+    return true_barcodes, (false_to_true, true_to_false)
 
 
 def getCellWhitelist(cell_barcode_counts,
                      error_correct_threshold=0,
-                     plotfile_prefix=None):
+                     plotfile_prefix=None,
+                     method="knee"):
+
+    if method == "network":
+        # the network groups define the error correction mappings
+        cell_whitelist, error_correct_mappings = getNetworkEstimate(
+            cell_barcode_counts, threshold=max(error_correct_threshold, 1),
+            plotfile_prefix=plotfile_prefix)
+        if error_correct_threshold == 0:
+            error_correct_mappings = None
+        return cell_whitelist, error_correct_mappings
 
     cell_whitelist = getKneeEstimate(
         cell_barcode_counts, plotfile_prefix=plotfile_prefix)
@@ -316,11 +387,32 @@ def get_umi_tag(read, tag='RX'):
             "check UMI is encoded in the read tag: %s" % tag)
 
 
+def get_umi_getter(options):
+    ''' return the method with which to extract umis from reads, as set
+    by options.get_umi_method '''
+
+    if options.get_umi_method == "read_id":
+        return ReadIdUMIGetter(sep=options.umi_sep)
+    elif options.get_umi_method == "tag":
+        return TagUMIGetter(tag=options.umi_tag)
+    else:
+        raise ValueError("Unknown umi extraction method")
+
+
 def get_average_umi_distance(umis):
 
     if len(umis) == 1:
         return -1
 
+    packed_umis = encode_umis(list(umis))
+    if packed_umis is not None:
+        codes, masks = packed_umis
+        n_umis = len(codes)
+        total = sum(hamming_distances(codes[i], masks[i],
+                                      codes[i+1:], masks[i+1:]).sum()
+                    for i in range(n_umis - 1))
+        return float(total)/(n_umis * (n_umis - 1) // 2)
+
     dists = [edit_distance(x, y) for
              x, y in itertools.combinations(umis, 2)]
     return float(sum(dists))/(len(dists))
@@ -800,9 +892,11 @@ class TwoPassPairWriter:
     def write_mates(self):
         '''Scan the current chromosome for matches to any of the reads stored
         in the read1s buffer'''
-        if self.chrom is not None:
-            U.debug("Dumping %i mates for contig %s" % (
-                len(self.read1s), self.chrom))
+        if self.chrom is None:
+            return
+
+        U.debug("Dumping %i mates for contig %s" % (
+            len(self.read1s), self.chrom))
 
         for read in self.infile.fetch(reference=self.chrom, multiple_iterators=True):
             if any((read.is_unmapped, read.mate_is_unmapped, read.is_read1)):
@@ -820,6 +914,12 @@ class TwoPassPairWriter:
         unmatched reads'''
 
         self.write_mates()
+        self.search_mates()
+        self.outfile.close()
+
+    def search_mates(self):
+        '''Search the whole file for matches to any unmatched reads'''
+
         U.info("Searching for mates for %i unmatched alignments" %
                len(self.read1s))
 
@@ -837,35 +937,6 @@ class TwoPassPairWriter:
                 continue
 
         U.info("%i mates never found" % len(self.read1s))
-        self.outfile.close()
-
-
-def get_read_position(read, soft_clip_threshold):
-    ''' '''
-    is_spliced = False
-
-    if read.is_reverse:
-        pos = read.aend
-        if read.cigar[-1][0] == 4:
-            pos = pos + read.cigar[-1][1]
-        start = read.pos
-
-        if ('N' in read.cigarstring or
-            (read.cigar[0][0] == 4 and
-             read.cigar[0][1] > soft_clip_threshold)):
-            is_spliced = True
-    else:
-        pos = read.pos
-        if read.cigar[0][0] == 4:
-            pos = pos - read.cigar[0][1]
-        start = pos
-
-        if ('N' in read.cigarstring or
-            (read.cigar[-1][0] == 4 and
-             read.cigar[-1][1] > soft_clip_threshold)):
-            is_spliced = True
-
-    return start, pos, is_spliced
 
 
 def getMetaContig2contig(bamfile, gene_transcript_map):
@@ -896,6 +967,33 @@ def metafetcher(bamfile, metacontig2contig, metatag):
                 yield read
 
 
+def update_buffer_stats(buffer_stats, other):
+    ''' update the buffer stats from get_bundles or get_gene_count with
+    other, e.g. those of another chunk, taking the max of each '''
+
+    for key, value in other.items():
+        buffer_stats[key] = max(buffer_stats[key], value)
+
+
+def log_buffer_stats(buffer_stats):
+    ''' log the buffer stats from get_bundles or get_gene_count '''
+
+    U.info("Peak buffered reads: %i at %i positions" % (
+        buffer_stats["reads"], buffer_stats["positions"]))
+    if "window" in buffer_stats:
+        U.info("Bundling window: %ibp" % buffer_stats["window"])
+
+
+def get_hash_seed(random_seed=None):
+    ''' return a seed for hash selection in get_bundles: random_seed if
+    it is set, else a random seed '''
+
+    if random_seed is None:
+        return random.getrandbits(64)
+    else:
+        return random_seed % 2**64
+
+
 def get_bundles(inreads,
                 ignore_umi=False,
                 subset=None,
@@ -912,13 +1010,17 @@ def get_bundles(inreads,
                 umi_getter=None,
                 all_reads=False,
                 return_read2=False,
-                return_unmapped=False):
-
-    ''' Returns a dictionary of dictionaries, representing the unique reads at
-    a position/spliced/strand combination. The key to the top level dictionary
-    is a umi. Each dictionary contains a "read" entry with the best read, and a
-    count entry with the number of reads with that position/spliced/strand/umi
-    combination
+                return_unmapped=False,
+                window=1000,
+                adaptive_window=False,
+                hash_seed=None,
+                buffer_stats=None,
+                compiled=True):
+
+    ''' Returns a dictionary representing the unique reads at a
+    position/spliced/strand combination. The key to the dictionary is a
+    umi. Each value is a BundleEntry with the best read, and the count of
+    reads with that position/spliced/strand/umi combination
 
     ignore_umi: don't include the umi in the dict key
 
@@ -958,15 +1060,103 @@ def get_bundles(inreads,
     return_read2: Return read2s immediately as a single read
 
     return_unmapped: Return unmapped reads immediately as a single read
+
+    window: yield the bundles at positions more than this many bp
+    behind the start of the current read
+
+    adaptive_window: grow window to the length, including soft clipped
+    bases, of the longest read seen so far. A read's 5' position can't
+    be soft clipped further than this behind its start, but a longer
+    read may come later, so window is kept as the least window
+
+    hash_seed: if set, --subset and the choice between reads of equal
+    quality use a hash of the read name seeded with this instead of the
+    random module. The reads kept then don't depend on the read order
+    or on how the input is split up, and both mates of a pair are
+    treated alike
+
+    buffer_stats: if set, a collections.Counter updated with the most
+    reads ("reads") and positions ("positions") held when bundles were
+    yielded and, if bundling by position, the final window ("window").
+    See update_buffer_stats
+
+    compiled: use the compiled loop in _bundles rather than
+    get_bundles_python
     '''
 
+    if compiled:
+        bundler = get_bundles_compiled
+    else:
+        bundler = get_bundles_python
+
+    return bundler(inreads,
+                   ignore_umi=ignore_umi,
+                   subset=subset,
+                   quality_threshold=quality_threshold,
+                   paired=paired,
+                   spliced=spliced,
+                   soft_clip_threshold=soft_clip_threshold,
+                   per_contig=per_contig,
+                   gene_tag=gene_tag,
+                   skip_regex=skip_regex,
+                   whole_contig=whole_contig,
+                   read_length=read_length,
+                   detection_method=detection_method,
+                   umi_getter=umi_getter,
+                   all_reads=all_reads,
+                   return_read2=return_read2,
+                   return_unmapped=return_unmapped,
+                   window=window,
+                   adaptive_window=adaptive_window,
+                   hash_seed=hash_seed,
+                   buffer_stats=buffer_stats)
+
+
+def get_bundles_python(inreads,
+                       ignore_umi=False,
+                       subset=None,
+                       quality_threshold=0,
+                       paired=False,
+                       spliced=False,
+                       soft_clip_threshold=0,
+                       per_contig=False,
+                       gene_tag=None,
+                       skip_regex=None,
+                       whole_contig=False,
+                       read_length=False,
+                       detection_method=False,
+                       umi_getter=None,
+                       all_reads=False,
+                       return_read2=False,
+                       return_unmapped=False,
+                       window=1000,
+                       adaptive_window=False,
+                       hash_seed=None,
+                       buffer_stats=None):
+    ''' python version of get_bundles. See get_bundles for the
+    arguments '''
+
     last_pos = 0
     last_chr = ""
-    reads_dict = collections.defaultdict(
-        lambda: collections.defaultdict(
-            lambda: collections.defaultdict(dict)))
-    read_counts = collections.defaultdict(
-        lambda: collections.defaultdict(dict))
+
+    # BundleEntrys for each position, keyed by (key, umi)
+    reads_dict = {}
+
+    # heap of (position, order added) for the buffered positions, so
+    # that those more than window bp behind the current read can be popped
+    # without scanning every position in reads_dict
+    position_queue = []
+    n_positions = 0
+    queue_positions = not (per_contig or gene_tag or whole_contig)
+
+    # reads held in reads_dict, and the most reads and positions held
+    # when bundles were yielded, for tuning the window
+    n_buffered = 0
+    peak_buffered = 0
+    peak_positions = 0
+
+    # the hash of the current read, for hash selection
+    read_hash = 0
 
     read_events = collections.Counter()
 
@@ -1004,8 +1194,15 @@ def get_bundles(inreads,
         if paired:
             read_events['Paired Reads'] += 1
 
+        if hash_seed is not None and (subset or not all_reads):
+            read_hash = get_read_hash(read, hash_seed)
+
         if subset:
-            if random.random() >= subset:
+            if hash_seed is not None:
+                selected = get_hash_fraction(read_hash) < subset
+            else:
+                selected = random.random() < subset
+            if not selected:
                 read_events['Randomly excluded'] += 1
                 continue
 
@@ -1014,6 +1211,9 @@ def get_bundles(inreads,
                 read_events['< MAPQ threshold'] += 1
                 continue
 
+        start, read_pos, is_spliced = get_read_position(
+            read, soft_clip_threshold)
+
         # TS - some methods require deduping on a per contig or per
         # gene basis. To fit in with current workflow, simply assign
         # pos and key as contig
@@ -1031,37 +1231,58 @@ def get_bundles(inreads,
 
             if not pos == last_chr:
 
+                peak_buffered = max(peak_buffered, n_buffered)
+                peak_positions = max(peak_positions, len(reads_dict))
+
                 out_keys = list(reads_dict.keys())
 
                 for p in out_keys:
-                    for bundle in reads_dict[p].values():
+                    out_entries = reads_dict.pop(p)
+                    for bundle in group_entries(out_entries):
                         yield bundle, read_events, 'mapped'
-                    del reads_dict[p]
-                    del read_counts[p]
+                    n_buffered -= count_buffered(out_entries, all_reads)
 
                 last_chr = pos
 
         else:
 
-            start, pos, is_spliced = get_read_position(
-                read, soft_clip_threshold)
+            pos = read_pos
+
+            if adaptive_window:
+                # the query length from the cigar, including soft
+                # clipped bases
+                read_span = read.infer_query_length()
+                if read_span > window:
+                    window = read_span
 
             if whole_contig:
                 do_output = not read.tid == last_chr
             else:
-                do_output = start > (last_pos+1000) or not read.tid == last_chr
+                do_output = (start > (last_pos+window) or
+                             not read.tid == last_chr)
 
             if do_output:
+                peak_buffered = max(peak_buffered, n_buffered)
+                peak_positions = max(peak_positions, len(reads_dict))
+
                 if not read.tid == last_chr:
                     out_keys = list(reads_dict.keys())
+                    position_queue = []
                 else:
-                    out_keys = [x for x in reads_dict.keys() if x <= start-1000]
+                    expired = []
+                    while (position_queue and
+                           position_queue[0][0] <= start-window):
+                        expired.append(heapq.heappop(position_queue))
+
+                    # output positions in the order they were added
+                    expired.sort(key=lambda x: x[1])
+                    out_keys = [p for p, order in expired]
 
                 for p in out_keys:
-                    for bundle in reads_dict[p].values():
+                    out_entries = reads_dict.pop(p)
+                    for bundle in group_entries(out_entries):
                         yield bundle, read_events, 'mapped'
-                    del reads_dict[p]
-                    del read_counts[p]
+                    n_buffered -= count_buffered(out_entries, all_reads)
 
                 last_pos = start
                 last_chr = read.tid
@@ -1079,64 +1300,90 @@ def get_bundles(inreads,
         else:
             umi = umi_getter(read)
 
-        # The content of the reads_dict depends on whether all reads
-        # are being retained
+        try:
+            entries = reads_dict[pos]
+        except KeyError:
+            entries = reads_dict[pos] = {}
+            if queue_positions:
+                heapq.heappush(position_queue, (pos, n_positions))
+                n_positions += 1
+
+        try:
+            entry = entries[key, umi]
+        except KeyError:
+            # The content of the entry depends on whether all reads
+            # are being retained
+            if all_reads:
+                entries[key, umi] = BundleEntry([read], [read_pos])
+            else:
+                entries[key, umi] = BundleEntry(read, read_hash=read_hash)
+            n_buffered += 1
+            continue
+
+        entry.count += 1
 
         if all_reads:
             # retain all reads per key
-            try:
-                reads_dict[pos][key][umi]["count"] += 1
-            except KeyError:
-                reads_dict[pos][key][umi]["read"] = [read]
-                reads_dict[pos][key][umi]["count"] = 1
-                read_counts[pos][key][umi] = 0
-            else:
-                reads_dict[pos][key][umi]["read"].append(read)
+            entry.read.append(read)
+            entry.positions.append(read_pos)
+            n_buffered += 1
+            continue
 
-        else:
-            # retain just a single read per key
-            try:
-                reads_dict[pos][key][umi]["count"] += 1
-            except KeyError:
-                reads_dict[pos][key][umi]["read"] = read
-                reads_dict[pos][key][umi]["count"] = 1
-                read_counts[pos][key][umi] = 0
-            else:
-                if reads_dict[pos][key][umi]["read"].mapq > read.mapq:
-                    continue
+        # retain just a single read per key
+        if entry.read.mapq > read.mapq:
+            continue
 
-                if reads_dict[pos][key][umi]["read"].mapq < read.mapq:
-                    reads_dict[pos][key][umi]["read"] = read
-                    read_counts[pos][key][umi] = 0
-                    continue
+        if entry.read.mapq < read.mapq:
+            entry.read = read
+            entry.reservoir = 0
+            entry.read_hash = read_hash
+            continue
 
-                # TS: implemented different checks for multimapping here
-                if detection_method in ["NH", "X0"]:
-                    tag = detection_method
-                    if reads_dict[pos][key][umi]["read"].opt(tag) < read.opt(tag):
-                        continue
-                    elif reads_dict[pos][key][umi]["read"].opt(tag) > read.opt(tag):
-                        reads_dict[pos][key][umi]["read"] = read
-                        read_counts[pos][key][umi] = 0
+        # TS: implemented different checks for multimapping here
+        if detection_method in ["NH", "X0"]:
+            tag = detection_method
+            if entry.read.opt(tag) < read.opt(tag):
+                continue
+            elif entry.read.opt(tag) > read.opt(tag):
+                entry.read = read
+                entry.reservoir = 0
+                entry.read_hash = read_hash
 
-                elif detection_method == "XT":
-                    if reads_dict[pos][key][umi]["read"].opt("XT") == "U":
-                        continue
-                    elif read.opt("XT") == "U":
-                        reads_dict[pos][key][umi]["read"] = read
-                        read_counts[pos][key][umi] = 0
+        elif detection_method == "XT":
+            if entry.read.opt("XT") == "U":
+                continue
+            elif read.opt("XT") == "U":
+                entry.read = read
+                entry.reservoir = 0
+                entry.read_hash = read_hash
+
+        if hash_seed is not None:
+            # keep the read with the lowest hash, whatever the read order
+            if read_hash < entry.read_hash:
+                entry.read = read
+                entry.read_hash = read_hash
+            continue
 
-                read_counts[pos][key][umi] += 1
-                prob = 1.0/read_counts[pos][key][umi]
+        entry.reservoir += 1
+        prob = 1.0/entry.reservoir
 
-                if random.random() < prob:
-                    reads_dict[pos][key][umi]["read"] = read
+        if random.random() < prob:
+            entry.read = read
 
     # yield remaining bundles
+    peak_buffered = max(peak_buffered, n_buffered)
+    peak_positions = max(peak_positions, len(reads_dict))
+
     for p in reads_dict:
-        for bundle in reads_dict[p].values():
+        for bundle in group_entries(reads_dict[p]):
             yield bundle, read_events, 'mapped'
 
+    if buffer_stats is not None:
+        update_buffer_stats(buffer_stats, {"reads": peak_buffered,
+                                           "positions": peak_positions})
+        if queue_positions:
+            update_buffer_stats(buffer_stats, {"window": window})
+
 
 def get_gene_count(inreads,
                    subset=None,
@@ -1145,7 +1392,9 @@ def get_gene_count(inreads,
                    per_contig=False,
                    gene_tag=None,
                    skip_regex=None,
-                   umi_getter=None):
+                   umi_getter=None,
+                   hash_seed=None,
+                   buffer_stats=None):
 
     ''' Yields the counts per umi for each gene
 
@@ -1167,11 +1416,25 @@ def get_gene_count(inreads,
                 such as "Unassigned"
 
     umi_getter: method to get umi from read, e.g get_umi_read_id or get_umi_tag
+
+    hash_seed: if set, subset using a hash of the read name seeded with
+    this, as in get_bundles
+
+    buffer_stats: if set, updated as in get_bundles, where the
+    positions are the genes
     '''
 
     last_chr = ""
     gene = ""
 
+    # the most reads counted and genes held when genes were yielded
+    peak_buffered = 0
+    peak_positions = 0
+
+    def get_buffered():
+        return sum(umi["count"] for gene_counts in counts_dict.values()
+                   for umi in gene_counts.values())
+
     # make an empty counts_dict counter
     counts_dict = collections.defaultdict(
         lambda: collections.defaultdict(dict))
@@ -1193,7 +1456,12 @@ def get_gene_count(inreads,
             read_events['Paired Reads'] += 1
 
         if subset:
-            if random.random() >= subset:
+            if hash_seed is not None:
+                selected = get_hash_fraction(
+                    get_read_hash(read, hash_seed)) < subset
+            else:
+                selected = random.random() < subset
+            if not selected:
                 read_events['Skipped - Randomly excluded'] += 1
                 continue
 
@@ -1214,8 +1482,11 @@ def get_gene_count(inreads,
         # overlapping genes
         if read.tid != last_chr:
 
-            for gene in counts_dict:
-                yield gene, counts_dict[gene], read_events
+            peak_buffered = max(peak_buffered, get_buffered())
+            peak_positions = max(peak_positions, len(counts_dict))
+
+            for out_gene in counts_dict:
+                yield out_gene, counts_dict[out_gene], read_events
 
             last_chr = read.tid
 
@@ -1230,9 +1501,16 @@ def get_gene_count(inreads,
             counts_dict[gene][umi]["count"] = 1
 
     # yield remaining genes
+    peak_buffered = max(peak_buffered, get_buffered())
+    peak_positions = max(peak_positions, len(counts_dict))
+
     for gene in counts_dict:
         yield gene, counts_dict[gene], read_events
 
+    if buffer_stats is not None:
+        update_buffer_stats(buffer_stats, {"reads": peak_buffered,
+                                           "positions": peak_positions})
+
 
 class random_read_generator:
     ''' class to generate umis at random based on the